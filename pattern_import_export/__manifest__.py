@@ -28,6 +28,7 @@
         "views/templates.xml",
         "data/queue_job_channel_data.xml",
         "data/queue_job_function_data.xml",
+        "data/ir_cron_data.xml",
     ],
     "demo": ["demo/demo.xml"],
     "installable": True,
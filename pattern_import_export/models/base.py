@@ -1,18 +1,21 @@
 # Copyright 2020 Akretion France (http://www.akretion.com)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
-import copy
+import itertools
 import logging
+from collections import defaultdict
+
+import psycopg2
 
 from odoo import _, api, models
 from odoo.exceptions import ValidationError
+from odoo.models import PGERROR_TO_OE
 from odoo.osv import expression
+from odoo.tools.lru import LRU
 
-from .common import IDENTIFIER_SUFFIX
+from .common import COLUMN_X2M_SEPARATOR, IDENTIFIER_SUFFIX
 
 _logger = logging.getLogger(__name__)
 
-FLOAT_INF = float("inf")
-
 
 def is_not_empty(item):
     if not item:
@@ -36,35 +39,71 @@ class Base(models.AbstractModel):
         export = export_pattern._export_with_record(self)
         return export
 
+    def _prefetch_for_pattern_export(self, parser_fields):
+        """Read in bulk the fields of the jsonify parser for the whole recordset
+        and recursively prefetch the related records of the sub-parsers"""
+        fnames = []
+        subparsers = []
+        for item in parser_fields:
+            if isinstance(item, tuple):
+                item, subparser = item
+                subparsers.append((item["name"], subparser))
+            fnames.append(item["name"])
+        fnames = [fname for fname in fnames if fname in self._fields]
+        if not self or not fnames:
+            return
+        self.read(fnames, load=None)
+        for fname, subparser in subparsers:
+            field = self._fields.get(fname)
+            if field and field.relational:
+                self.mapped(fname)._prefetch_for_pattern_export(subparser)
+
     # There is a native bug in odoo
     # when load records if it fail odoo will rollback and try to load them one by one
     # in order to have explicit error
     # The issue is if the create/write method modify the dict vals
     # the modification will be kept and this can generate issue when loading one by one
-    # Do a deepcopy to avoid this issue
+    # Instead of doing a deepcopy of every vals, when a row is loaded again
+    # the vals are converted again from the extracted row
     # TODO try to reproduce it on native odoo and open a ticket
 
-    def _load_records_write(self, values):
-        return super()._load_records_write(copy.deepcopy(values))
-
-    def _load_records_create(self, values):
-        return super()._load_records_create(copy.deepcopy(values))
+    def _get_pattern_retry_values(self, data):
+        pattern_config = self._context["pattern_config"]
+        idx = data["info"]["rows"]["from"]
+        res = pattern_config.get("extracted_rows", {}).get(idx)
+        if res is None:
+            return data["values"]
+        messages = []
+        for dbid, xid, values, __ in self._convert_records(
+            [(res, data["info"])], log=messages.append
+        ):
+            # same as load, the database id is injected in the vals
+            if dbid and not xid:
+                values["id"] = dbid
+            return values
+        return data["values"]
 
     def _load_records(self, data_list, update=False):
-        records = super()._load_records(data_list, update=update)
-        if self._context.get("pattern_config"):
-            self._context["pattern_config"]["record_ids"] += records.ids
-        return records
+        pattern_config = self._context.get("pattern_config")
+        if pattern_config:
+            loaded_rows = pattern_config.setdefault("loaded_rows", set())
+            for data in data_list:
+                idx = data.get("info", {}).get("rows", {}).get("from")
+                if idx is None:
+                    continue
+                elif idx in loaded_rows:
+                    data["values"] = self._get_pattern_retry_values(data)
+                loaded_rows.add(idx)
+        return super()._load_records(data_list, update=update)
 
     def load(self, fields, data):
-        result = super().load(fields, data)
-        if not result["ids"] and self._context.get("pattern_config", {}).get(
-            "record_ids"
-        ):
-            result["ids"] = self._context["pattern_config"]["record_ids"]
-        return result
+        if self._context.get("pattern_config"):
+            result = self._pattern_load(data)
+            result["nextrow"] = 0
+            return result
+        return super().load(fields, data)
 
-    def _pattern_format2json(self, row):
+    def _pattern_format2json(self, row, process_key=True):
         def convert_header_key(key):
             return [int(k) if k.isdigit() else k for k in key.split("|")]
 
@@ -95,7 +134,9 @@ class Base(models.AbstractModel):
                     current = current[previous_key]
                 previous_key = key
             current[keys[-1]] = vals
-        return self._post_process_key(res)
+        if process_key:
+            self._post_process_key(res)
+        return res
 
     def _clean_identifier_key(self, res, ident_keys):
         for key in ident_keys:
@@ -153,10 +194,11 @@ class Base(models.AbstractModel):
             return field.inverse_name
         return None
 
-    def _post_process_o2m_fields(self, res, parent_do_not_exist):
-        """Post process one2many field
+    def _get_o2m_subitems(self, res):
+        """Return the valid item of the one2many fields of res
         - remove all empty item
-        - post process key on each valid item (with the parent_id in domain)
+        - return the item with the domain to use (with the parent_id)
+        @return: list of (comodel_name, subitem, subdomain, parent_do_not_exist)
         """
         if ".id" in res:
             parent_id = res[".id"]
@@ -165,6 +207,7 @@ class Base(models.AbstractModel):
         else:
             parent_id = None
 
+        subitems = []
         for key in res:
             field = self._fields.get(key)
             if field and field.type == "one2many":
@@ -176,13 +219,37 @@ class Base(models.AbstractModel):
                 for subitem in res[key]:
                     if is_not_empty(subitem):
                         valid_subitems.append(subitem)
-                        self.env[field._related_comodel_name]._post_process_key(
-                            subitem, subdomain, not bool(parent_id)
+                        subitems.append(
+                            (
+                                field._related_comodel_name,
+                                subitem,
+                                subdomain,
+                                not bool(parent_id),
+                            )
                         )
                 res[key] = valid_subitems
+        return subitems
+
+    def _post_process_o2m_fields(self, res, parent_do_not_exist):
+        """Post process one2many field
+        - remove all empty item
+        - post process key on each valid item (with the parent_id in domain)
+        """
+        for (
+            comodel_name,
+            subitem,
+            subdomain,
+            subparent_do_not_exist,
+        ) in self._get_o2m_subitems(res):
+            self.env[comodel_name]._post_process_key(
+                subitem, subdomain, subparent_do_not_exist
+            )
 
     def _set_record_id_from_domain(self, res, ident_keys, domain):
         record = self.with_context(active_test=False).search(domain)
+        self._set_record_id_from_found(res, ident_keys, record)
+
+    def _set_record_id_from_found(self, res, ident_keys, record):
         if len(record) > 1:
             raise ValidationError(
                 _("Too many {} found for the key/value : {}").format(
@@ -195,6 +262,118 @@ class Base(models.AbstractModel):
             for key in ident_keys:
                 res.pop(key)
 
+    def _get_field_from_path(self, path):
+        """Return the field targeted by the path "field1.field2..."
+        or None if one of the field do not exist or is not stored"""
+        model = self
+        field = None
+        for name in path.split("."):
+            if field is not None:
+                if not field.relational:
+                    return None
+                model = self.env[field.comodel_name]
+            field = model._fields.get(name)
+            if field is None or not field.store or field.company_dependent:
+                return None
+        return field
+
+    def _normalize_key_value(self, path, value):
+        """Convert the value of the key to the python type of the field
+        so it can be compared to the value read on the record.
+        Return None if the value can not be resolved in bulk"""
+        if value is None or isinstance(value, (bool, dict, list)):
+            return None
+        field = self._get_field_from_path(path)
+        if field is None:
+            return None
+        if field.type in ("integer", "many2one"):
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                return None
+        elif field.type in ("char", "text", "selection") and isinstance(value, str):
+            return value
+        return None
+
+    def _get_key_values(self, record, path):
+        values = record.mapped(path)
+        if isinstance(values, models.BaseModel):
+            values = values.ids
+        return set(values)
+
+    def _search_records_by_keys(self, conditions_list):
+        """Search in bulk the records matching each list of conditions
+        The conditions are grouped by fields so only one query is done
+        for each set of fields. Conditions that can not be matched in python
+        (empty value, float...) fallback on a classic search
+
+        @param conditions_list: list of list of (field_path, value)
+        @return: list of recordset, one for each conditions
+        """
+        model = self.with_context(active_test=False)
+        results = [None] * len(conditions_list)
+        groups = defaultdict(list)
+        for position, conditions in enumerate(conditions_list):
+            normalized = {
+                path: self._normalize_key_value(path, value)
+                for path, value in conditions
+            }
+            if len(normalized) != len(conditions) or None in normalized.values():
+                results[position] = model.search(
+                    [(path, "=", value) for path, value in conditions]
+                )
+            else:
+                groups[tuple(sorted(normalized))].append((position, normalized))
+
+        for paths, items in groups.items():
+            if len(paths) == 1:
+                domain = [
+                    (paths[0], "in", list({item[paths[0]] for __, item in items}))
+                ]
+            else:
+                domain = expression.OR(
+                    [[(path, "=", item[path]) for path in paths] for __, item in items]
+                )
+            index = defaultdict(lambda: model.browse())
+            for record in model.search(domain):
+                for values in itertools.product(
+                    *[self._get_key_values(record, path) for path in paths]
+                ):
+                    index[values] |= record
+            for position, item in items:
+                results[position] = index[tuple(item[path] for path in paths)]
+        return results
+
+    def _post_process_keys(self, items):
+        """Bulk version of _post_process_key
+        All the items of the model are resolved together and then the
+        items of the one2many are processed together by comodel
+
+        @param items: list of (res, domain, parent_do_not_exist)
+        """
+        ident_keys_list = []
+        todo = []
+        for res, domain, parent_do_not_exist in items:
+            domain_key, ident_keys = self._get_domain_from_identifier_key(res)
+            ident_keys_list.append(ident_keys)
+            if domain_key and not parent_do_not_exist:
+                conditions = [(leaf[0], leaf[2]) for leaf in list(domain) + domain_key]
+                todo.append((res, ident_keys, conditions))
+
+        records = self._search_records_by_keys([conditions for *__, conditions in todo])
+        for (res, ident_keys, __), record in zip(todo, records):
+            self._set_record_id_from_found(res, ident_keys, record)
+
+        subitems = defaultdict(list)
+        for res, __, __ in items:
+            for comodel_name, *subitem in self._get_o2m_subitems(res):
+                subitems[comodel_name].append(subitem)
+        for comodel_name, comodel_items in subitems.items():
+            self.env[comodel_name]._post_process_keys(comodel_items)
+
+        for (res, __, __), ident_keys in zip(items, ident_keys_list):
+            self._clean_identifier_key(res, ident_keys)
+
     def _post_process_key(self, res, domain=None, parent_do_not_exist=False):
         """Process identifier key
         - search existing record and inject id
@@ -225,33 +404,247 @@ class Base(models.AbstractModel):
                 row[key] = row[key].strip()
 
     @api.model
-    def _extract_records(self, fields_, data, log=lambda a: None, limit=FLOAT_INF):
-        pattern_config = self._context.get("pattern_config")
-        if pattern_config:
-            for idx, row in data:
-                self._strip_string(row)
-                self._remove_commented_and_empty_columns(row)
-                if not any(row.values()):
-                    continue
+    def _get_rows_with_duplicated_key(self, rows):
+        """Return the index of the rows having the same identifier key
+        as a previous row of the chunk
+        @param rows: list of (idx, res)
+        @return: set of idx
+        """
+        keys = set()
+        duplicated = set()
+        for idx, res in rows:
+            domain_key, __ = self._get_domain_from_identifier_key(res)
+            if not domain_key:
+                continue
+            key = repr(domain_key)
+            if key in keys:
+                duplicated.add(idx)
+            keys.add(key)
+        return duplicated
 
-                yield self._pattern_format2json(row), {"rows": {"from": idx, "to": idx}}
-
-                # WARNING: complex code
-                # As we are in an generator the following code is executed
-                # after the "for id, xid, record, info in converted:" in model.py:1090
-                # the idea is to call the flush manually for the last line
-                # and set new savepoint so the rollback in case of error
-                # "if any(message['type'] == 'error' for message in messages):"
-                # in model.py:1100
-                # will do nothing
-                # this is a crazy hack but there is no better solution
-                # in V15 we should propose a refactor of load method
-                if data[-1][0] == idx:
-                    self._context["import_flush"]()
-                    self._cr.execute("RELEASE SAVEPOINT model_load")
-                    self._cr.execute("SAVEPOINT model_load")
+    @api.model
+    def _pattern_extract_rows(self, data):
+        """Extract the rows of the chunk and resolve their identifier keys
+        The keys of the chunk are resolved in bulk, except for the rows
+        with the same key as a previous row: the previous rows are loaded
+        before resolving it, so the record created by a previous row
+        is updated instead of creating a duplicate
+        @return: iterator of (res, info)
+        """
+        rows = []
+        for idx, row in data:
+            self._strip_string(row)
+            self._remove_commented_and_empty_columns(row)
+            if not any(row.values()):
+                continue
+            rows.append((idx, self._pattern_format2json(row, process_key=False)))
+
+        self._context["pattern_config"]["extracted_rows"] = dict(rows)
+        duplicated = self._get_rows_with_duplicated_key(rows)
+        self._post_process_keys(
+            [(res, [], False) for idx, res in rows if idx not in duplicated]
+        )
+        for idx, res in rows:
+            if idx in duplicated:
+                self._context["import_flush"]()
+                self._post_process_keys([(res, [], False)])
+            yield res, {"rows": {"from": idx, "to": idx}}
+
+    def _get_pattern_load_message(self, info, error, fields_get):
+        if isinstance(error, psycopg2.Warning):
+            return dict(info, type="warning", message=str(error))
+        elif isinstance(error, psycopg2.Error):
+            return dict(
+                info,
+                type="error",
+                **PGERROR_TO_OE[error.pgcode](self, fields_get, info, error),
+            )
         else:
-            yield from super()._extract_records(fields_, data, log=log, limit=limit)
+            _logger.debug("Error while loading record", exc_info=True)
+            return dict(
+                info,
+                type="error",
+                message=_("Unknown error during import:")
+                + " {}: {}".format(type(error), error),
+                moreinfo=_("Resolve other errors first"),
+            )
+
+    @api.model
+    def _iter_pending_vals(self, vals_list):
+        """Iterate on the vals and on the vals of the one2many
+        commands that create records of the same model (ex: child_ids)"""
+        for vals in vals_list:
+            yield vals
+            for key, commands in vals.items():
+                field = self._fields.get(key)
+                if (
+                    field
+                    and field.type == "one2many"
+                    and field.comodel_name == self._name
+                    and isinstance(commands, list)
+                ):
+                    yield from self._iter_pending_vals(
+                        [
+                            command[2]
+                            for command in commands
+                            if isinstance(command, (list, tuple))
+                            and len(command) == 3
+                            and isinstance(command[2], dict)
+                        ]
+                    )
+
+    @api.model
+    def _match_pending_rows(self, batch, subfield, value):
+        """Return True if a pending row (not loaded yet) may be found
+        by searching the subfield with the value.
+        If we can not know it from the vals, we consider that the row match"""
+        field = self._fields.get(subfield)
+        if not field or not field.store or field.compute or field.relational:
+            return True
+        for vals in self._iter_pending_vals([vals for __, vals, __ in batch]):
+            if subfield not in vals:
+                if field.default:
+                    return True
+            elif str(vals[subfield]) == str(value):
+                return True
+        return False
+
+    @api.model
+    def _get_pattern_creatable_models(self, data):
+        """Return the models of the records that can be created by the rows
+        (like the native load): the imported model, the comodels of the
+        one2many columns and of the many2one with name_create enabled"""
+        creatable_models = {self._name}
+        name_create = self._context.get("name_create_enabled_fieds") or {}
+        headers = {header for __, row in data for header in row}
+        for header in headers:
+            if not header or header.startswith("#"):
+                continue
+            names = [
+                name.replace(IDENTIFIER_SUFFIX, "")
+                for name in header.split(COLUMN_X2M_SEPARATOR)
+                if not name.isdigit()
+            ]
+            model_fields = self._fields
+            field = model_fields.get(names[0])
+            if field and field.type == "many2one" and names[0] in name_create:
+                creatable_models.add(field.comodel_name)
+            for name in names:
+                field = model_fields.get(name)
+                if field is None or field.type != "one2many":
+                    break
+                creatable_models.add(field.comodel_name)
+                model_fields = self.env[field.comodel_name]._fields
+        return creatable_models
+
+    @api.model
+    def _pattern_load_log(self, result, message):
+        """Add the message of a row that can not be loaded, the import is
+        interrupted after too many errors with the same rule as the native
+        load (Odoo 14.0 BaseModel.load)"""
+        result["messages"].append(message)
+        if message["type"] != "error":
+            return
+        result["errors"] += 1
+        if result["errors"] >= 10 and result["errors"] >= result["done"] / 10:
+            result["interrupted"] = True
+            result["messages"].append(
+                {
+                    "type": "warning",
+                    "message": _(
+                        "Found more than 10 errors and more than one error per "
+                        "10 records, interrupted to avoid showing too many errors."
+                    ),
+                }
+            )
+
+    @api.model
+    def _pattern_load_batch(self, data_list, result, fields_get):
+        """Load the data list in a savepoint, if it fails the data list is
+        split in two halves recursively in order to isolate the failing rows
+        (instead of loading them one by one like the native load)
+
+        @param data_list: list of dict for _load_records
+        @param result: dict with the "ids", the "messages" and the counters
+        of the loaded rows, updated in place
+        """
+        if result["interrupted"]:
+            return
+        try:
+            with self._cr.savepoint():
+                records = self._load_records(data_list)
+            result["ids"].extend(records.ids)
+            result["done"] += len(data_list)
+            return
+        except Exception as e:
+            if len(data_list) > 1:
+                half = len(data_list) // 2
+                self._pattern_load_batch(data_list[:half], result, fields_get)
+                self._pattern_load_batch(data_list[half:], result, fields_get)
+                return
+            message = self._get_pattern_load_message(
+                data_list[0]["info"], e, fields_get
+            )
+        result["done"] += 1
+        self._pattern_load_log(result, message)
+
+    @api.model
+    def _pattern_load(self, data):
+        """Import the rows of a pattern chunk
+        It mirrors the native load of Odoo 14.0 (BaseModel.load): same
+        import context, conversion and error messages, except that:
+        - the converted rows are loaded by batch, a failing batch is split
+          in two halves recursively (see _pattern_load_batch)
+        - the pending rows are only loaded when a lookup may need them
+          (see the flush below) and the valid rows are kept even if some
+          rows fail
+
+        @param data: list of (idx, row)
+        @return: dict with the "ids" imported and the "messages"
+        """
+        current_module = self._context.get("module", "__import__")
+        self = self.with_context(_import_current_module=current_module)
+        fields_get = self.fields_get()
+        creatable_models = self._get_pattern_creatable_models(data)
+        result = {
+            "ids": [],
+            "messages": [],
+            "done": 0,
+            "errors": 0,
+            "interrupted": False,
+        }
+        batch = []
+
+        def flush(*, xml_id=None, model=None, subfield=None, value=None):
+            """Load the pending rows, if the lookup (xml_id or subfield/value)
+            can not match any pending row there is no need to flush"""
+            if not batch:
+                return
+            elif model and model not in creatable_models:
+                return
+            elif xml_id and not any(xml_id == xid for xid, __, __ in batch):
+                return
+            elif subfield and not self._match_pending_rows(batch, subfield, value):
+                return
+            data_list = [
+                {"xml_id": xid, "values": vals, "info": info, "noupdate": False}
+                for xid, vals, info in batch
+            ]
+            batch.clear()
+            self._pattern_load_batch(data_list, result, fields_get)
+
+        flush_self = self.with_context(import_flush=flush, import_cache=LRU(1024))
+        extracted = flush_self._pattern_extract_rows(data)
+        for dbid, xid, record, info in flush_self._convert_records(
+            extracted, log=result["messages"].append
+        ):
+            if xid:
+                xid = xid if "." in xid else "{}.{}".format(current_module, xid)
+            elif dbid:
+                record["id"] = dbid
+            batch.append((xid, record, info))
+        flush()
+        return {"ids": result["ids"], "messages": result["messages"]}
 
     @api.model
     def _convert_records(self, records, log=lambda a: None):
@@ -259,7 +652,7 @@ class Base(models.AbstractModel):
             # Note the log method is equal to messages.append
             # so log.__self__ return the messages list
             messages = log.__self__
-            if messages and messages[-1]["rows"] == info["rows"]:
+            if messages and messages[-1].get("rows") == info["rows"]:
                 # we have a message for this item so we skip it from conversion
                 # so the record will be not imported
                 continue
@@ -3,3 +3,6 @@
 
 IDENTIFIER_SUFFIX = "#key"
 COLUMN_X2M_SEPARATOR = "|"
+
+# size of the export kept in memory before writing it on the disk
+SPOOLED_MAX_SIZE = 10 * 1024 * 1024
@@ -53,6 +53,23 @@ class IrExportsLine(models.Model):
         "Value should be >= 1",
     )
 
+    def _get_pattern_cache_key(self):
+        """Return the values of the line used to build the header and the
+        parser of the pattern (see pattern.config._get_pattern_cache_key)
+        @return: tuple
+        """
+        self.ensure_one()
+        return (
+            self.id,
+            self.write_date,
+            self.name,
+            self.is_key,
+            self.number_occurence,
+            self.resolver_id.id,
+            self.instance_method_name,
+            self.sub_pattern_config_id.id,
+        )
+
     @api.model
     def _get_last_relation_field(self, model, path, level=1):
         if "/" not in path:
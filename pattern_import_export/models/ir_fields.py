@@ -3,6 +3,7 @@
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
 import ast
+from collections import defaultdict
 
 from odoo import _, api, models
 from odoo.osv import expression
@@ -48,6 +49,79 @@ class IrFieldsConverter(models.AbstractModel):
                 [subfield] = fieldset
                 return subfield, []
 
+    @api.model
+    def _search_db_id_for(self, field, domain, subfield, value):
+        """Search the record referenced by the subfield/value
+        The result is cached for the whole import as the same values are
+        often repeated on each row. The imported model is never cached as
+        the records can be created during the import (it's flushed instead)
+        """
+        comodel = field._related_comodel_name
+        pattern_config = self.env.context.get("pattern_config", {})
+        if pattern_config.get("model") == comodel:
+            # the pending rows are only loaded if one of them can match
+            # import_flush is not available when the values are converted
+            # again for loading a row one by one
+            if "import_flush" in self._context:
+                self._context["import_flush"](subfield=subfield, value=value)
+            cache = None
+        else:
+            cache = pattern_config.get("lookup_cache")
+        search_domain = expression.AND([domain, [(subfield, "=", value)]])
+        if cache is None:
+            return self.env[comodel].search(search_domain)
+        key = self._get_lookup_cache_key(field, domain, subfield, value)
+        if key not in cache:
+            cache[key] = self.env[comodel].search(search_domain).ids
+        return self.env[comodel].browse(cache[key])
+
+    @api.model
+    def _get_lookup_cache_key(self, field, domain, subfield, value):
+        return (field._related_comodel_name, repr(domain), subfield, repr(value))
+
+    @api.model
+    def _get_db_id_for_domain(self, field):
+        # Only list domain and server-side evaluable are supported
+        # as they can be apply on server-side
+        if isinstance(field.domain, list):
+            return field.domain
+        try:
+            return ast.literal_eval(field.domain)
+        except ValueError:
+            return []
+
+    @api.model
+    def _prefetch_db_id_for(self, field, subfield, values):
+        """Search in one query the records referenced by the subfield
+        for all the values and fill the lookup cache used by db_id_for"""
+        comodel = field._related_comodel_name
+        pattern_config = self.env.context.get("pattern_config", {})
+        cache = pattern_config.get("lookup_cache")
+        subfield_field = self.env[comodel]._fields.get(subfield)
+        if (
+            cache is None
+            or pattern_config.get("model") == comodel
+            or not subfield_field
+            or subfield_field.relational
+        ):
+            return
+        domain = self._get_db_id_for_domain(field)
+        ids_by_value = defaultdict(list)
+        for vals in (
+            self.env[comodel]
+            .with_context(active_test=False)
+            .search_read(
+                expression.AND([domain, [(subfield, "in", list(values))]]), [subfield]
+            )
+        ):
+            ids_by_value[vals[subfield]].append(vals["id"])
+        for value in values:
+            # only the found values are cached, the missing one (or the one
+            # that do not have the same type) are searched by db_id_for
+            if value in ids_by_value:
+                key = self._get_lookup_cache_key(field, domain, subfield, value)
+                cache[key] = ids_by_value[value]
+
     @api.model
     def db_id_for(self, model, field, subfield, value):
         # We alway search on all record even inactive one as we may want to use
@@ -57,22 +131,8 @@ class IrFieldsConverter(models.AbstractModel):
             return super().db_id_for(model, field, subfield, value)
         else:
             if value:
-                # Only list domain and server-side evaluable are supported
-                # as they can be apply on server-side
-                if isinstance(field.domain, list):
-                    domain = field.domain
-                else:
-                    try:
-                        domain = ast.literal_eval(field.domain)
-                    except ValueError:
-                        domain = []
-                domain = expression.AND([domain, [(subfield, "=", value)]])
-                if (
-                    self.env.context.get("pattern_config", {}).get("model")
-                    == field._related_comodel_name
-                ):
-                    self._context["import_flush"]()
-                record = self.env[field._related_comodel_name].search(domain)
+                domain = self._get_db_id_for_domain(field)
+                record = self._search_db_id_for(field, domain, subfield, value)
                 if len(record) > 1:
                     raise self._format_import_error(
                         ValueError,
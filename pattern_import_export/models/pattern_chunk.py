@@ -2,7 +2,33 @@
 # @author Sébastien BEAU <sebastien.beau@akretion.com>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
-from odoo import fields, models
+import base64
+import json
+import logging
+import tempfile
+import time
+import zlib
+from collections import defaultdict
+from datetime import timedelta
+
+import psycopg2
+
+from odoo import _, api, fields, models
+from odoo.osv import expression
+from odoo.service.model import (
+    MAX_TRIES_ON_CONCURRENCY_FAILURE,
+    PG_CONCURRENCY_ERRORS_TO_RETRY,
+)
+from odoo.tools import split_every
+
+from odoo.addons.queue_job.job import identity_exact
+
+from .common import COLUMN_X2M_SEPARATOR, IDENTIFIER_SUFFIX, SPOOLED_MAX_SIZE
+
+_logger = logging.getLogger(__name__)
+
+# number of chunks purged (and committed) together
+PURGE_BATCH_SIZE = 1000
 
 
 class PatternChunk(models.Model):
@@ -17,14 +43,33 @@ class PatternChunk(models.Model):
     start_idx = fields.Integer()
     stop_idx = fields.Integer()
     data = fields.Serialized()
+    compressed_data = fields.Binary(
+        attachment=False,
+        help="Data of the chunk compressed with zlib, used instead of 'data' "
+        "when the compression is activated on the pattern",
+    )
+    is_data_purged = fields.Boolean(
+        readonly=True, help="The data have been dropped by the purge of the chunks"
+    )
     record_ids = fields.Serialized()
     messages = fields.Serialized()
     result_info = fields.Html()
     nbr_error = fields.Integer()
     nbr_success = fields.Integer()
     nbr_item = fields.Integer()
+    estimated_cost = fields.Float()
+    duration = fields.Float(help="Duration of the import in seconds")
+    depends_on_ids = fields.Many2many(
+        "pattern.chunk",
+        "pattern_chunk_dependency_rel",
+        "chunk_id",
+        "depends_on_id",
+        string="Depends On",
+        help="Chunks that create records referenced by this chunk",
+    )
     state = fields.Selection(
         selection=[
+            ("waiting", "Waiting"),
             ("pending", "Pending"),
             ("started", "Started"),
             ("done", "Done"),
@@ -32,41 +77,245 @@ class PatternChunk(models.Model):
         ]
     )
 
+    @api.model
+    def _compress_data(self, data):
+        return base64.b64encode(zlib.compress(json.dumps(data).encode("utf-8")))
+
+    def _get_data(self):
+        """Return the data of the chunk, the compressed data are only
+        decoded when calling this method"""
+        compressed_data = self.with_context(bin_size=False).compressed_data
+        if compressed_data:
+            return json.loads(
+                zlib.decompress(base64.b64decode(compressed_data)).decode("utf-8")
+            )
+        return self.data
+
+    def _get_purge_domain(self, config):
+        now = fields.Datetime.now()
+        domains = []
+        if config.chunk_data_retention_days:
+            limit_date = now - timedelta(days=config.chunk_data_retention_days)
+            domains.append([("state", "=", "done"), ("write_date", "<", limit_date)])
+        if config.chunk_retention_days:
+            limit_date = now - timedelta(days=config.chunk_retention_days)
+            domains.append([("pattern_file_id.date_done", "<", limit_date)])
+        if not domains:
+            return None
+        return expression.AND(
+            [
+                [
+                    ("pattern_file_id.pattern_config_id", "=", config.id),
+                    ("is_data_purged", "=", False),
+                ],
+                expression.OR(domains),
+            ]
+        )
+
+    @api.model
+    def _purge_data(self):
+        """Drop the data of the chunks that are not needed anymore
+        (see the retention days on the pattern config).
+        The counters and the messages are kept.
+        The chunks are purged by batch, each batch is committed"""
+        for config in self.env["pattern.config"].search([]):
+            domain = self._get_purge_domain(config)
+            if not domain:
+                continue
+            for ids in split_every(PURGE_BATCH_SIZE, self.search(domain).ids):
+                chunks = self.browse(ids)
+                chunks.write(
+                    {"data": False, "compressed_data": False, "is_data_purged": True}
+                )
+                self.env.cr.commit()  # pylint: disable=invalid-commit
+                chunks.invalidate_cache()
+        return True
+
+    def _get_related_column(self, model, header, with_xmlid=False):
+        """Return the (field, subfield) referenced by the header if the column
+        is resolved by a search on the related model (ex: country_id|code)
+        or by its external id if with_xmlid is True (ex: parent_id|id)"""
+        if not header or header.startswith("#"):
+            return None
+        names = [
+            name.replace(IDENTIFIER_SUFFIX, "")
+            for name in header.split(COLUMN_X2M_SEPARATOR)
+            if not name.isdigit()
+        ]
+        for position, name in enumerate(names):
+            field = model._fields.get(name)
+            if field is None:
+                return None
+            elif field.type == "one2many":
+                model = self.env[field.comodel_name]
+            elif (
+                field.type in ("many2one", "many2many")
+                and len(names) == position + 2
+                and (
+                    names[-1] not in ("id", ".id") or (with_xmlid and names[-1] == "id")
+                )
+            ):
+                return field, names[-1]
+            else:
+                return None
+        return None
+
+    def _get_related_values(self, model, data):
+        """Collect the distinct values of each column referencing a related
+        record
+        @return: dict {(field, subfield): set of values}
+        """
+        columns = {}
+        related_values = defaultdict(set)
+        for __, row in data:
+            for header, value in row.items():
+                if header not in columns:
+                    columns[header] = self._get_related_column(model, header)
+                if not columns[header]:
+                    continue
+                if isinstance(value, str):
+                    value = value.strip()
+                if value and isinstance(value, (str, int)) and value is not True:
+                    related_values[columns[header]].add(value)
+        return related_values
+
+    def _normalize_reference(self, subfield, value):
+        value = str(value).strip()
+        if subfield == "id" and "." not in value:
+            value = "__import__.{}".format(value)
+        return subfield, value
+
+    def _get_references(self, model, data):
+        """Return the keys (subfield, value) used by the rows
+        to reference a record of the imported model (ex: parent_id|name)"""
+        references = set()
+        columns = {}
+        for __, row in data:
+            for header, value in row.items():
+                if header not in columns:
+                    column = self._get_related_column(model, header, with_xmlid=True)
+                    if column and column[0].comodel_name != model._name:
+                        column = None
+                    columns[header] = column
+                if columns[header] and value not in (None, False, ""):
+                    references.add(self._normalize_reference(columns[header][1], value))
+        return references
+
+    def _get_reference_subfields(self, model, headers):
+        """Return the subfields used by the columns referencing a record
+        of the imported model (ex: name for parent_id|name)"""
+        subfields = set()
+        for header in headers:
+            column = self._get_related_column(model, header, with_xmlid=True)
+            if column and column[0].comodel_name == model._name:
+                subfields.add(column[1])
+        return subfields
+
+    def _get_provided_keys(self, model, data, subfields):
+        """Return the keys (subfield, value) of the records imported
+        by the rows, only the columns of the subfields used to reference
+        a record are read (see _get_reference_subfields)"""
+        keys = set()
+        columns = {}
+        for __, row in data:
+            for header, value in row.items():
+                if header not in columns:
+                    subfield = None
+                    if header and COLUMN_X2M_SEPARATOR not in header:
+                        subfield = header.replace(IDENTIFIER_SUFFIX, "")
+                        if subfield not in subfields:
+                            subfield = None
+                    columns[header] = subfield
+                if (
+                    columns[header]
+                    and value not in (None, False, "")
+                    and isinstance(value, (str, int))
+                    and value is not True
+                ):
+                    keys.add(self._normalize_reference(columns[header], value))
+        return keys
+
+    def _prefetch_related_records(self, model, data):
+        """Resolve in bulk the values of the related columns so the
+        conversion of the rows do not need a search per cell"""
+        converter = self.env["ir.fields.converter"]
+        for (field, subfield), values in self._get_related_values(model, data).items():
+            converter._prefetch_db_id_for(field, subfield, values)
+
+    def _load_data(self, model, data):
+        """Load the data in a savepoint, if it fail the data are split
+        in two halves recursively in order to only reject the failing rows
+
+        @param data: list of (idx, row)
+        @return: dict with the "ids" imported and the "messages"
+        """
+        try:
+            with self.env.cr.savepoint():
+                return model._pattern_load(data)
+        except Exception as e:
+            if len(data) == 1:
+                idx = data[0][0]
+                return {
+                    "ids": [],
+                    "messages": [
+                        {
+                            "type": "error",
+                            "message": _("Fail to process the row: %s") % e,
+                            "rows": {"from": idx, "to": idx},
+                        }
+                    ],
+                }
+        half = len(data) // 2
+        res = {"ids": [], "messages": []}
+        for part in (data[:half], data[half:]):
+            part_res = self._load_data(model, part)
+            res["ids"] += part_res["ids"]
+            res["messages"] += part_res["messages"]
+        return res
+
     def run_import(self):
         model = self.pattern_file_id.pattern_config_id.model_id.model
-        res = (
-            self.with_context(
-                pattern_config={
-                    "model": model,
-                    "record_ids": [],
-                    "purge_one2many": (
-                        self.pattern_file_id.pattern_config_id.purge_one2many
-                    ),
-                }
-            )
-            .env[model]
-            .load([], self.data)
+        chunk = self.with_context(
+            pattern_config={
+                "model": model,
+                "lookup_cache": {},
+                "purge_one2many": (
+                    self.pattern_file_id.pattern_config_id.purge_one2many
+                ),
+            }
         )
-        self.write(self._prepare_chunk_result(res))
+        data = self._get_data()
+        chunk._prefetch_related_records(chunk.env[model], data)
+        start = time.perf_counter()
+        res = chunk._load_data(chunk.env[model], data)
+        vals = self._prepare_chunk_result(res)
+        vals["duration"] = time.perf_counter() - start
+        self.write(vals)
         config = self.pattern_file_id.pattern_config_id
         priority = config.job_priority
         if not config.process_multi:
             next_chunk = self.get_next_chunk()
             if next_chunk:
                 next_chunk.with_delay(priority=priority).run()
-            else:
-                self.with_delay(priority=5).check_last()
-        else:
-            self.with_delay(priority=5).check_last()
 
     def run(self):
         """Process Import of Pattern Chunk"""
+        return self._run_in_savepoint(self.run_import)
+
+    def run_export(self):
+        """Process Export of Pattern Chunk"""
+        return self._run_in_savepoint(self.export_records)
+
+    def _run_in_savepoint(self, process):
         cr = self.env.cr
+        if self.state in ("done", "failed"):
+            # the job has been run again after the chunk was committed
+            return "Chunk already processed"
         try:
             self.state = "started"
             cr.commit()  # pylint: disable=invalid-commit
             with cr.savepoint():
-                self.run_import()
+                process()
         except Exception as e:
             self.write(
                 {
@@ -75,9 +324,54 @@ class PatternChunk(models.Model):
                     "state": "failed",
                 }
             )
-            self.with_delay().check_last()
+        # the result of the chunk is committed before checking the other
+        # chunks, so a concurrent update only retries the check
+        cr.commit()  # pylint: disable=invalid-commit
+        try:
+            self._check_last_with_retry()
+        except Exception:
+            # the job must not fail now: it would import the chunk again
+            _logger.exception("Fail to check the chunks of %s", self.pattern_file_id)
+            cr.rollback()
+            self.env.clear()
+            self.with_delay(priority=5).check_last()
         return "OK"
 
+    def export_records(self):
+        """Export the records of the chunk in a partial file
+        that will be merged in the pattern file"""
+        config = self.pattern_file_id.pattern_config_id
+        records = self.env[config.resource].browse(self.data).exists()
+        target_function = "_export_to_file_{}".format(config.export_format)
+        with tempfile.SpooledTemporaryFile(max_size=SPOOLED_MAX_SIZE) as output:
+            # the header is only added when merging the parts
+            getattr(config.with_context(pattern_export_part=True), target_function)(
+                records, output
+            )
+            output.seek(0)
+            self.env["ir.attachment"].create(
+                {
+                    "name": "{}.part{}".format(
+                        self.pattern_file_id.name, self.start_idx
+                    ),
+                    "raw": output.read(),
+                    "res_model": self._name,
+                    "res_id": self.id,
+                }
+            )
+        self.write(
+            {
+                "state": "done",
+                "nbr_success": len(records),
+                "nbr_error": self.nbr_item - len(records),
+            }
+        )
+
+    def _get_export_attachment(self):
+        return self.env["ir.attachment"].search(
+            [("res_model", "=", self._name), ("res_id", "=", self.id)], limit=1
+        )
+
     def _prepare_chunk_result(self, res):
         # TODO rework this part and add specific test case
         nbr_error = len(res["messages"])
@@ -115,14 +409,48 @@ class PatternChunk(models.Model):
         )
 
     def is_last_job(self):
-        return not self.pattern_file_id.chunk_ids.filtered(
-            lambda s: s.state in ("pending", "started")
-        )
+        states = self.pattern_file_id._get_chunk_states()
+        return not any(states.get(state) for state in ("waiting", "pending", "started"))
+
+    def _check_last_with_retry(self):
+        """Call check_last, the check is done again in a new transaction
+        if a chunk of the same file has been processed concurrently"""
+        cr = self.env.cr
+        tries = 0
+        while True:
+            try:
+                return self.check_last()
+            except psycopg2.OperationalError as e:
+                if e.pgcode not in PG_CONCURRENCY_ERRORS_TO_RETRY:
+                    raise
+                if tries >= MAX_TRIES_ON_CONCURRENCY_FAILURE:
+                    raise
+                tries += 1
+                cr.rollback()
+                self.env.clear()
 
     def check_last(self):
         """Check if all chunk have been processed"""
+        pattern_file = self.pattern_file_id
+        pattern_file._lock_for_chunk_check()
+        if pattern_file.state != "pending":
+            return "Pattern file is already processed"
+        # in sequential mode the waiting chunks are only enqueued
+        # when there is no more chunk to process
+        states = pattern_file._get_chunk_states()
+        if pattern_file.pattern_config_id.process_multi or not (
+            states.get("pending") or states.get("started")
+        ):
+            if pattern_file._enqueue_ready_chunks():
+                return "There is still some running chunk"
         if self.is_last_job():
-            self.pattern_file_id.set_import_done()
+            if pattern_file.kind == "export":
+                pattern_file.with_delay(
+                    priority=pattern_file.pattern_config_id.job_priority,
+                    identity_key=identity_exact,
+                ).merge_export()
+            else:
+                pattern_file.set_import_done()
             return "Pattern file is done"
         else:
             return "There is still some running chunk"
@@ -2,11 +2,16 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 import ast
 import base64
+import json
+import shutil
+import tempfile
+from io import BytesIO
 
 from odoo import _, api, fields, models
 from odoo.osv import expression
+from odoo.tools import ormcache, split_every
 
-from .common import COLUMN_X2M_SEPARATOR, IDENTIFIER_SUFFIX
+from .common import COLUMN_X2M_SEPARATOR, IDENTIFIER_SUFFIX, SPOOLED_MAX_SIZE
 
 
 class PatternConfig(models.Model):
@@ -15,6 +20,12 @@ class PatternConfig(models.Model):
     To implements:
     _export_with_record_FORMAT (should use an iterator)
     _read_import_data_FORMAT (should return an iterator)
+    Optionally for streaming the export in a temporary file:
+    _export_to_file_FORMAT (write the export in the binary file given)
+    Optionally for exporting by chunk (see export_multi):
+    _merge_export_parts_FORMAT (merge the files exported by each chunk)
+    Optionally for the report of the rows in error (see error_report):
+    _write_error_report_FORMAT (write the rows in error in the binary file given)
     """
 
     _inherits = {"ir.exports": "export_id"}
@@ -37,20 +48,94 @@ class PatternConfig(models.Model):
             "record that are not present in you file"
         )
     )
+    error_report = fields.Boolean(
+        help="When the import fails, generate a small file with only the rows "
+        "in error (original values and error message) that can be fixed and "
+        "imported again",
+    )
     pattern_file = fields.Binary(string="Pattern file", readonly=True)
     pattern_file_name = fields.Char(readonly=True)
     pattern_last_generation_date = fields.Datetime(
         string="Pattern last generation date", readonly=True
     )
-    export_format = fields.Selection(selection=[("json", "Json")])
+    export_format = fields.Selection(
+        selection=[("json", "Json"), ("jsonl", "JSON Lines")]
+    )
     chunk_size = fields.Integer(default=500, help="Define the size of the chunk")
+    chunk_sizing = fields.Selection(
+        selection=[("count", "Number of items"), ("duration", "Duration")],
+        default="count",
+        required=True,
+        help="Number of items: each import chunk contains 'chunk_size' items.\n"
+        "Duration: the items are weighted by their estimated cost (nested "
+        "items, columns) and the chunks are sized to last 'chunk_duration' "
+        "seconds based on the timings of the previous chunks",
+    )
+    chunk_compression = fields.Boolean(
+        help="Store the data of the import chunks compressed (zlib) instead of "
+        "serialized json, the data are only decoded when the chunk is imported",
+    )
+    chunk_data_retention_days = fields.Integer(
+        default=30,
+        help="Number of days the data of the done chunks are kept "
+        "(0 to keep them forever). The counters and messages are kept",
+    )
+    chunk_retention_days = fields.Integer(
+        help="Number of days the data of all the chunks (even the failed one) "
+        "are kept after the end of the file processing (0 to keep them "
+        "forever). The counters and messages are kept",
+    )
+    chunk_duration = fields.Integer(
+        default=60, help="Target duration of an import chunk in seconds"
+    )
+    export_batch_size = fields.Integer(
+        default=1000,
+        help="Number of records read together when exporting.\n"
+        "All the fields (and sub-pattern relations) are fetched in bulk "
+        "for each batch",
+    )
     count_pattern_file_failed = fields.Integer(compute="_compute_pattern_file_counts")
     count_pattern_file_pending = fields.Integer(compute="_compute_pattern_file_counts")
     count_pattern_file_done = fields.Integer(compute="_compute_pattern_file_counts")
     pattern_file_ids = fields.One2many("pattern.file", "pattern_config_id")
     process_multi = fields.Boolean()
+    export_multi = fields.Boolean(
+        help="Split the export in chunks of 'chunk_size' records, each chunk is "
+        "exported in its own job and the results are merged in one file",
+    )
     job_priority = fields.Integer(default=20)
 
+    def _get_chunk_cost_rate(self, limit=20):
+        """Return the average duration (in seconds) of one unit of cost
+        measured on the last import chunks of the pattern"""
+        chunks = self.env["pattern.chunk"].search_read(
+            [
+                ("pattern_file_id.pattern_config_id", "=", self.id),
+                ("pattern_file_id.kind", "=", "import"),
+                ("state", "in", ("done", "failed")),
+                ("duration", ">", 0),
+                ("estimated_cost", ">", 0),
+            ],
+            ["duration", "estimated_cost"],
+            limit=limit,
+            order="id desc",
+        )
+        cost = sum(chunk["estimated_cost"] for chunk in chunks)
+        if not cost:
+            return None
+        return sum(chunk["duration"] for chunk in chunks) / cost
+
+    def _get_chunk_max_cost(self):
+        """Return the maximal cost of an import chunk, or None if the chunks
+        are only sized by the number of items"""
+        if self.chunk_sizing != "duration":
+            return None
+        rate = self._get_chunk_cost_rate()
+        if rate and self.chunk_duration:
+            return self.chunk_duration / rate
+        # no history: a flat item costs 1
+        return self.chunk_size
+
     # we redefine previous onchanges since delegation inheritance breaks
     # onchanges on ir.exports
 
@@ -67,15 +152,20 @@ class PatternConfig(models.Model):
             s.export_fields = False
 
     def _compute_pattern_file_counts(self):
+        counts = {}
+        if self.ids:
+            for group in self.env["pattern.file"].read_group(
+                [("pattern_config_id", "in", self.ids)],
+                ["pattern_config_id", "state"],
+                ["pattern_config_id", "state"],
+                lazy=False,
+            ):
+                key = (group["pattern_config_id"][0], group["state"])
+                counts[key] = group["__count"]
         for rec in self:
             for state in ("failed", "pending", "done"):
                 field_name = "count_pattern_file_" + state
-                count = len(
-                    rec.pattern_file_ids.filtered(
-                        lambda r, state=state: r.state == state
-                    ).ids
-                )
-                setattr(rec, field_name, count)
+                setattr(rec, field_name, counts.get((rec.id, state), 0))
 
     def _open_pattern_file(self, domain=None):
         if domain is None:
@@ -120,17 +210,86 @@ class PatternConfig(models.Model):
         headers.append(dict(zip(tech_header, tech_header)))
         return headers
 
+    def _get_pattern_cache_key(self):
+        """
+        Return a key that change each time the structure of the pattern
+        (config, export lines and sub-patterns) is modified.
+        The values of the export lines are in the key as the write date
+        does not change when a line is modified twice in a transaction
+        @return: tuple
+        """
+        self.ensure_one()
+        key = [self.id, self.write_date, self.env.lang]
+        for line in self.export_fields:
+            key.append(line._get_pattern_cache_key())
+            if line.sub_pattern_config_id:
+                key.append(line.sub_pattern_config_id._get_pattern_cache_key())
+        return tuple(key)
+
+    @ormcache("self._get_pattern_cache_key()", "use_description")
+    def _get_cached_header(self, use_description):
+        header = []
+        for export_line in self.export_fields:
+            header.extend(export_line._get_header(use_description))
+        return tuple(header)
+
     def _get_header(self, use_description=False):
         """
         Build header of data-structure.
         Could be recursive in case of lines with pattern_config_id.
+        The header is cached until the pattern is modified
         @return: list of string
         """
         self.ensure_one()
-        header = []
-        for export_line in self.export_fields:
-            header.extend(export_line._get_header(use_description))
-        return header
+        return list(self._get_cached_header(use_description))
+
+    @ormcache("self._get_pattern_cache_key()")
+    def _get_cached_json_parser(self):
+        """Return the parser fields with the id of the resolvers,
+        the records must not be kept in the cache"""
+        parser = self.export_fields._get_json_parser_for_pattern()
+        return self._map_parser_fields(parser["fields"], self._unbind_parser_field)
+
+    def _map_parser_fields(self, parser_fields, function):
+        """Return a copy of the parser fields with the function applied
+        on each field (and on the fields of the sub-parsers)"""
+        res = []
+        for item in parser_fields:
+            if isinstance(item, tuple):
+                item, subparser = item
+                res.append(
+                    (function(item), self._map_parser_fields(subparser, function))
+                )
+            else:
+                res.append(function(item))
+        return res
+
+    def _unbind_parser_field(self, item):
+        if item.get("resolver"):
+            item = dict(item, resolver=item["resolver"].id)
+        return item
+
+    def _bind_parser_field(self, item):
+        if item.get("resolver"):
+            item = dict(
+                item, resolver=self.env["ir.exports.resolver"].browse(item["resolver"])
+            )
+        return item
+
+    def _bind_parser_to_env(self, parser_fields):
+        """Return a copy of the cached parser fields with the resolvers
+        browsed in the current environment"""
+        return self._map_parser_fields(parser_fields, self._bind_parser_field)
+
+    def _get_json_parser(self):
+        """
+        Return the jsonify parser of the pattern.
+        The parser is cached until the pattern is modified
+        @return: dict
+        """
+        self.ensure_one()
+        parser = self._get_cached_json_parser()
+        return {"fields": self._bind_parser_to_env(parser["fields"])}
 
     def generate_pattern(self):
         """
@@ -153,28 +312,68 @@ class PatternConfig(models.Model):
             )
         return True
 
+    def _split_records_to_export(self, records):
+        """Split the recordset to export in batch of export_batch_size"""
+        self.ensure_one()
+        batch_size = self.export_batch_size or len(records) or 1
+        for ids in split_every(batch_size, records.ids):
+            yield records.browse(ids)
+
     def _get_data_to_export(self, records):
         """
         Iterator who built data dict record by record.
+        Records are jsonified by batch, each batch is prefetched
+        (including sub-pattern relations) and then removed from the cache.
         This function could be recursive in case of sub-pattern
         """
         self.ensure_one()
-        json_parser = self.export_fields._get_json_parser_for_pattern()
-        for record in records:
-            yield self._get_data_to_export_by_record(record, json_parser)
+        json_parser = self._get_json_parser()
+        accessors = self._get_header_accessors()
+        for batch in self._split_records_to_export(records):
+            batch._prefetch_for_pattern_export(json_parser["fields"])
+            for data in batch.jsonify(json_parser):
+                yield self._format_data_to_export(data, accessors=accessors)
+            # free the memory used by the cache before processing the next batch
+            batch.invalidate_cache()
 
-    def json2pattern_format(self, data):
+    @api.model
+    def _compile_header_path(self, header):
+        """
+        Convert a header into the path of keys to read in the jsonify data
+        ex: "child_ids|2|country_id#key|code" => ("child_ids", 1, "country_id", "code")
+        @param header: str
+        @return: tuple
+        """
+        path = []
+        for key in header.split(COLUMN_X2M_SEPARATOR):
+            if key.isdigit():
+                key = int(key) - 1
+            elif IDENTIFIER_SUFFIX in key:
+                key = key.replace(IDENTIFIER_SUFFIX, "")
+            if key == ".id":
+                key = "id"
+            path.append(key)
+        return tuple(path)
+
+    def _get_header_accessors(self):
+        """
+        Compile the header once into a list of (header, path)
+        so the conversion of each record do not have to parse the header
+        @return: list of tuple
+        """
+        self.ensure_one()
+        return [
+            (header, self._compile_header_path(header)) for header in self._get_header()
+        ]
+
+    def json2pattern_format(self, data, accessors=None):
+        if accessors is None:
+            accessors = self._get_header_accessors()
         res = {}
-        for header in self._get_header():
+        for header, path in accessors:
+            val = data
             try:
-                val = data
-                for key in header.split(COLUMN_X2M_SEPARATOR):
-                    if key.isdigit():
-                        key = int(key) - 1
-                    elif IDENTIFIER_SUFFIX in key:
-                        key = key.replace(IDENTIFIER_SUFFIX, "")
-                    if key == ".id":
-                        key = "id"
+                for key in path:
                     val = val[key]
                     if val is None:
                         break
@@ -193,7 +392,16 @@ class PatternConfig(models.Model):
         self.ensure_one()
         record.ensure_one()
         data = record.jsonify(parser)[0]
-        return self.json2pattern_format(data)
+        return self._format_data_to_export(data)
+
+    def _format_data_to_export(self, data, accessors=None):
+        """
+        Convert the data returned by jsonify into a row
+        @param data: dict
+        @param accessors: precompiled header (see _get_header_accessors)
+        @return: dict
+        """
+        return self.json2pattern_format(data, accessors=accessors)
 
     def _generate_with_records(self, records):
         """
@@ -223,34 +431,180 @@ class PatternConfig(models.Model):
         @return: ir.attachment recordset
         """
         pattern_file_exports = self.env["pattern.file"]
-        all_data = self._generate_with_records(records)
-        if all_data and self.env.context.get("export_as_attachment", True):
-            for export, attachment_data in zip(self, all_data):
-                pattern_file_exports |= export._create_pattern_file_export(
-                    attachment_data
-                )
+        export_as_attachment = self.env.context.get("export_as_attachment", True)
+        for export in self:
+            if export_as_attachment and export._can_export_by_chunk(records):
+                pattern_file_exports |= export._export_with_record_by_chunk(records)
+                continue
+            if export_as_attachment and export._can_export_to_file():
+                pattern_file_exports |= export._export_with_record_to_file(records)
+                continue
+            all_data = export._generate_with_records(records)
+            if all_data and export_as_attachment:
+                pattern_file_exports |= export._create_pattern_file_export(all_data[0])
         return pattern_file_exports
 
-    def _create_pattern_file_export(self, attachment_datas):
+    def _can_export_to_file(self):
+        self.ensure_one()
+        return hasattr(self, "_export_to_file_{}".format(self.export_format))
+
+    def _can_export_by_chunk(self, records):
+        self.ensure_one()
+        return (
+            self.export_multi
+            and self.chunk_size
+            and len(records) > self.chunk_size
+            and self._can_export_to_file()
+            and hasattr(self, "_merge_export_parts_{}".format(self.export_format))
+        )
+
+    def _export_with_record_by_chunk(self, records):
         """
-        Attach given parameter (b64 encoded) to the current export.
-        @param attachment_datas: base64 encoded data
-        @return: ir.attachment recordset
+        Split the export in chunks exported in parallel jobs,
+        the pattern file is filled when all the chunks are done
+        @param records: recordset
+        @return: pattern.file recordset (pending)
         """
         self.ensure_one()
         name = "{name}.{format}".format(name=self.name, format=self.export_format)
-        return self.env["pattern.file"].create(
+        pattern_file = self.env["pattern.file"].create(
             {
                 "name": name,
                 "type": "binary",
                 "res_id": self.id,
                 "res_model": "pattern.config",
-                "datas": attachment_datas,
                 "kind": "export",
-                "state": "done",
+                "state": "pending",
                 "pattern_config_id": self.id,
             }
         )
+        pattern_file.split_export_in_chunk(records)
+        return pattern_file
+
+    def _export_with_record_to_file(self, records):
+        """
+        Export given recordset by streaming it in a temporary file,
+        the file content is directly stored in the attachment without
+        being encoded in base64.
+        Only the export is streamed: the content is read once when creating
+        the attachment as ir.attachment only accepts the whole content
+        @param records: recordset
+        @return: ir.attachment recordset
+        """
+        self.ensure_one()
+        target_function = "_export_to_file_{}".format(self.export_format)
+        with tempfile.SpooledTemporaryFile(max_size=SPOOLED_MAX_SIZE) as output:
+            getattr(self, target_function)(records, output)
+            output.seek(0)
+            return self._create_pattern_file_export(raw=output.read())
+
+    def _create_pattern_file_export(self, attachment_datas=None, raw=None):
+        """
+        Attach given parameter (b64 encoded) to the current export.
+        @param attachment_datas: base64 encoded data
+        @param raw: not encoded data (used instead of attachment_datas)
+        @return: ir.attachment recordset
+        """
+        self.ensure_one()
+        name = "{name}.{format}".format(name=self.name, format=self.export_format)
+        vals = {
+            "name": name,
+            "type": "binary",
+            "res_id": self.id,
+            "res_model": "pattern.config",
+            "kind": "export",
+            "state": "done",
+            "pattern_config_id": self.id,
+        }
+        if raw is not None:
+            vals["raw"] = raw
+        else:
+            vals["datas"] = attachment_datas
+        return self.env["pattern.file"].create(vals)
+
+    def _export_to_file_json(self, records, output):
+        """
+        Write the json array of the rows in the binary file given,
+        the rows are written one by one.
+        When exporting a chunk (see export_multi) the brackets are only
+        added when merging the parts
+        @param records: recordset
+        @param output: binary file object
+        """
+        self.ensure_one()
+        is_part = self._context.get("pattern_export_part")
+        if not is_part:
+            output.write(b"[")
+        for position, row in enumerate(self._get_data_to_export(records)):
+            if position:
+                output.write(b",")
+            output.write(json.dumps(row, ensure_ascii=False).encode("utf-8"))
+        if not is_part:
+            output.write(b"]")
+
+    def _export_with_record_json(self, records):
+        self.ensure_one()
+        output = BytesIO()
+        self._export_to_file_json(records, output)
+        return output.getvalue()
+
+    def _merge_export_parts_json(self, records, parts, output):
+        """
+        Concatenate the rows exported by each chunk in one json array
+        @param records: recordset exported
+        @param parts: iterator of binary file object
+        @param output: binary file object
+        """
+        self.ensure_one()
+        output.write(b"[")
+        separator = b""
+        for part in parts:
+            # the part of a chunk without record is empty
+            start = part.read(1)
+            if not start:
+                continue
+            output.write(separator + start)
+            shutil.copyfileobj(part, output)
+            separator = b","
+        output.write(b"]")
+
+    def _export_to_file_jsonl(self, records, output):
+        """
+        Write one json object per line in the binary file given
+        @param records: recordset
+        @param output: binary file object
+        """
+        self.ensure_one()
+        for row in self._get_data_to_export(records):
+            output.write(json.dumps(row, ensure_ascii=False).encode("utf-8"))
+            output.write(b"\n")
+
+    def _export_with_record_jsonl(self, records):
+        self.ensure_one()
+        output = BytesIO()
+        self._export_to_file_jsonl(records, output)
+        return output.getvalue()
+
+    def _merge_export_parts_jsonl(self, records, parts, output):
+        self.ensure_one()
+        for part in parts:
+            shutil.copyfileobj(part, output)
+
+    def _write_error_report_json(self, header, items, output):
+        """
+        Write the rows in error in the binary file given
+        @param header: list of the columns
+        @param items: list of dict
+        @param output: binary file object
+        """
+        self.ensure_one()
+        output.write(json.dumps(items, ensure_ascii=False).encode("utf-8"))
+
+    def _write_error_report_jsonl(self, header, items, output):
+        self.ensure_one()
+        for item in items:
+            output.write(json.dumps(item, ensure_ascii=False).encode("utf-8"))
+            output.write(b"\n")
 
     def _add_update_tabs(self, result, tab_name, tab_vals):
         if tab_name in result["tabs"]:
@@ -3,9 +3,24 @@
 
 import base64
 import json
+import logging
+import os
+import tempfile
 import urllib.parse
+from io import BytesIO
 
 from odoo import _, api, fields, models
+from odoo.exceptions import UserError
+from odoo.tools import split_every
+
+from .common import COLUMN_X2M_SEPARATOR, SPOOLED_MAX_SIZE
+
+_logger = logging.getLogger(__name__)
+
+# weight of each column in the estimated cost of an item
+COST_BY_COLUMN = 0.01
+# number of chunks created together when splitting a file
+CHUNK_CREATE_BATCH = 10
 
 
 class PatternFile(models.Model):
@@ -24,20 +39,39 @@ class PatternFile(models.Model):
     pattern_config_id = fields.Many2one(
         "pattern.config", required=True, string="Export pattern"
     )
-    nbr_error = fields.Integer(compute="_compute_stat")
-    nbr_success = fields.Integer(compute="_compute_stat")
-    progress = fields.Float(compute="_compute_stat")
+    nbr_error = fields.Integer(compute="_compute_stat", store=True)
+    nbr_success = fields.Integer(compute="_compute_stat", store=True)
+    nbr_item = fields.Integer(compute="_compute_stat", store=True)
+    progress = fields.Float(compute="_compute_stat", store=True)
     chunk_ids = fields.One2many("pattern.chunk", "pattern_file_id", "Chunk")
     date_done = fields.Datetime()
+    error_report = fields.Binary(
+        attachment=True, readonly=True, help="Rows in error of the import"
+    )
+    error_report_name = fields.Char(readonly=True)
 
-    @api.depends("chunk_ids.nbr_error", "chunk_ids.nbr_success")
+    # the counters of the chunks are not in the dependencies: they are
+    # recomputed when a chunk is processed (see _lock_for_chunk_check)
+    # to not update the pattern file in the transaction importing the chunk
+    @api.depends("chunk_ids")
     def _compute_stat(self):
+        stats = {}
+        if self.ids:
+            for group in self.env["pattern.chunk"].read_group(
+                [("pattern_file_id", "in", self.ids)],
+                ["pattern_file_id", "nbr_error", "nbr_success", "nbr_item"],
+                ["pattern_file_id"],
+            ):
+                stats[group["pattern_file_id"][0]] = group
         for record in self:
-            record.nbr_error = sum(record.mapped("chunk_ids.nbr_error"))
-            record.nbr_success = sum(record.mapped("chunk_ids.nbr_success"))
-            todo = sum(record.mapped("chunk_ids.nbr_item"))
-            if todo:
-                record.progress = (record.nbr_error + record.nbr_success) * 100.0 / todo
+            stat = stats.get(record.id, {})
+            record.nbr_error = stat.get("nbr_error") or 0
+            record.nbr_success = stat.get("nbr_success") or 0
+            record.nbr_item = stat.get("nbr_item") or 0
+            if record.nbr_item:
+                record.progress = (
+                    (record.nbr_error + record.nbr_success) * 100.0 / record.nbr_item
+                )
             else:
                 record.progress = 0
 
@@ -115,72 +149,451 @@ class PatternFile(models.Model):
         link += "<a href=" + url + ">" + _("Download") + "</a>"
         return link
 
+    def _open_data(self):
+        """Return a binary file object on the content of the file.
+        The file of the filestore is opened directly so the content
+        is not loaded in memory"""
+        self.ensure_one()
+        if self.store_fname:
+            path = self.attachment_id._full_path(self.store_fname)
+            if os.path.isfile(path):
+                return open(path, "rb")
+        return BytesIO(self.raw or b"")
+
     def _parse_data(self):
-        data = base64.b64decode(self.datas.decode("utf-8"))
         target_function = "_parse_data_{format}".format(
             format=self.pattern_config_id.export_format or ""
         )
         if not hasattr(self, target_function):
             raise NotImplementedError()
-        return getattr(self, target_function)(data)
+        with self._open_data() as datafile:
+            yield from getattr(self, target_function)(datafile)
 
-    def _parse_data_json(self, data):
-        items = json.loads(data.decode("utf-8"))
+    def _parse_data_json(self, datafile):
+        items = json.load(datafile)
         for idx, item in enumerate(items):
             yield idx + 1, item
 
+    def _parse_data_jsonl(self, datafile):
+        """Parse the file line by line, so only the current item is decoded.
+        The position returned is the line number (empty lines are skipped)"""
+        for idx, line in enumerate(datafile, start=1):
+            line = line.strip()
+            if line:
+                yield idx, json.loads(line.decode("utf-8"))
+
+    def _get_item_cost(self, item):
+        """Estimate the cost of importing an item, a flat item costs 1
+        and each nested item (one2many / many2many line) adds 1"""
+        nested = set()
+        for key in item:
+            if not key:
+                continue
+            names = key.split(COLUMN_X2M_SEPARATOR)
+            for position, name in enumerate(names):
+                if name.isdigit():
+                    nested.add(tuple(names[: position + 1]))
+        return 1 + len(nested) + len(item) * COST_BY_COLUMN
+
     def _prepare_chunk(self, start_idx, stop_idx, data):
-        return {
+        vals = {
             "start_idx": start_idx,
             "stop_idx": stop_idx,
-            "data": data,
             "nbr_item": len(data),
+            "estimated_cost": sum(self._get_item_cost(item) for __, item in data),
             "state": "pending",
             "pattern_file_id": self.id,
         }
+        if self.pattern_config_id.chunk_compression:
+            vals["compressed_data"] = self.env["pattern.chunk"]._compress_data(data)
+        else:
+            vals["data"] = data
+        return vals
 
     def _should_create_chunk(self, items, next_item):
         """Customise this code if you want to add some additionnal
-        item after reaching the limit"""
+        item after reaching the limit.
+        When the chunks are sized by duration, the cost of the items
+        is given by the context (see _iter_chunk_items)"""
+        sizing = self._context.get("pattern_chunk_sizing")
+        if sizing and sizing["max_cost"]:
+            return self._should_create_chunk_by_cost(
+                items, sizing["cost"], sizing["next_cost"], sizing["max_cost"]
+            )
         return len(items) > self.pattern_config_id.chunk_size
 
-    def _create_chunk(self, start_idx, stop_idx, data):
-        vals = self._prepare_chunk(start_idx, stop_idx, data)
-        chunk = self.env["pattern.chunk"].create(vals)
-        # we enqueue the chunk in case of multi process of if it's the first chunk
-        if self.pattern_config_id.process_multi or len(self.chunk_ids) == 1:
+    def _should_create_chunk_by_cost(self, items, cost, next_cost, max_cost):
+        """Used by _should_create_chunk when the chunks are sized by duration"""
+        return bool(items) and cost + next_cost > max_cost
+
+    def _lock_for_chunk_check(self):
+        """Lock the pattern file until the end of the transaction and
+        recompute its counters.
+        The row is updated and not only selected for update: with the
+        repeatable read isolation, a transaction waiting for the lock fails
+        to serialize instead of reading outdated chunk states"""
+        self.flush()
+        self.env.cr.execute(
+            """UPDATE pattern_file SET write_date = (now() at time zone 'UTC')
+            WHERE id IN %s""",
+            (tuple(self.ids),),
+            log_exceptions=False,
+        )
+        self.invalidate_cache(["write_date"])
+        self.modified(["chunk_ids"])
+
+    def _get_chunk_states(self):
+        """Return the number of chunks by state, counted in SQL
+        to not load all the chunks of the file"""
+        self.ensure_one()
+        self.env["pattern.chunk"].flush(["state", "pattern_file_id"])
+        self.env.cr.execute(
+            """SELECT state, count(*) FROM pattern_chunk
+            WHERE pattern_file_id = %s
+            GROUP BY state""",
+            (self.id,),
+        )
+        return dict(self.env.cr.fetchall())
+
+    def _enqueue_ready_chunks(self):
+        """Enqueue the waiting chunks for which all the dependencies
+        have been processed
+        @return: the enqueued chunks"""
+        self.ensure_one()
+        self.env["pattern.chunk"].flush(["state"])
+        # the state is updated in SQL to be sure that two concurrent jobs
+        # will not enqueue the same chunk
+        self.env.cr.execute(
+            """UPDATE pattern_chunk SET state = 'pending'
+            WHERE pattern_file_id = %s AND state = 'waiting'
+            AND NOT EXISTS (
+                SELECT 1 FROM pattern_chunk_dependency_rel rel
+                JOIN pattern_chunk dep ON dep.id = rel.depends_on_id
+                WHERE rel.chunk_id = pattern_chunk.id
+                AND dep.state NOT IN ('done', 'failed')
+            )
+            RETURNING id""",
+            (self.id,),
+        )
+        chunks = self.env["pattern.chunk"].browse(
+            sorted(row[0] for row in self.env.cr.fetchall())
+        )
+        chunks.invalidate_cache(["state"])
+        for chunk in chunks:
             chunk.with_delay(priority=self.pattern_config_id.job_priority).run()
-        return chunk
+        return chunks
+
+    def _iter_chunk_items(self, rows=None):
+        """Split the parsed data in chunks of items,
+        only the items of the current chunk are kept in memory
+        @param rows: iterator of (idx, item), the file is parsed if empty
+        @return: iterator of (start_idx, stop_idx, items)
+        """
+        if rows is None:
+            rows = self._parse_data()
+        items = []
+        start_idx = None
+        previous_idx = None
+        sizing = {
+            "max_cost": self.pattern_config_id._get_chunk_max_cost(),
+            "cost": 0,
+            "next_cost": 0,
+        }
+        record = self.with_context(pattern_chunk_sizing=sizing)
+        # idx is the index position in the original file
+        # we can have empty line that can be skipped
+        for idx, item in rows:
+            if sizing["max_cost"]:
+                sizing["next_cost"] = self._get_item_cost(item)
+            if record._should_create_chunk(items, item):
+                yield start_idx, previous_idx, items
+                items = []
+                sizing["cost"] = 0
+            if not items:
+                # the rows can be a selection of the file (see retry_failed)
+                start_idx = idx
+            items.append((idx, item))
+            sizing["cost"] += sizing["next_cost"]
+            previous_idx = idx
+        if items:
+            yield start_idx, previous_idx, items
+        else:
+            # document has an header and no data lines
+            # valid document. So create a dummy chunk
+            # to have progression and status
+            yield -1, -1, []
+
+    def _create_chunks(self, vals_list):
+        chunks = self.env["pattern.chunk"].create(vals_list)
+        # the data are stored, we do not need to keep them in memory
+        chunks.invalidate_cache(["data", "compressed_data"])
+        return chunks
 
     def split_in_chunk(self):
-        """Split Pattern File into Pattern Chunk"""
+        """Split Pattern File into Pattern Chunk
+        The chunks are created by batch while reading the file.
+        In case of multi process, the chunks that do not reference a record
+        imported by a previous chunk are enqueued in parallel, the others
+        wait for the end of the chunks they depend on
+        (see _enqueue_ready_chunks)"""
         # purge chunk in case of retring a job
         self.chunk_ids.unlink()
+        return self._split_rows_in_chunk()
+
+    def _split_rows_in_chunk(self, rows=None):
+        """Create and enqueue the chunks of the rows
+        @param rows: iterator of (idx, item), the file is parsed if empty
+        """
+        config = self.pattern_config_id
+        chunk_model = self.env["pattern.chunk"]
         try:
-            items = []
-            start_idx = 1
-            previous_idx = None
-            # idx is the index position in the original file
-            # we can have empty line that can be skipped
-            for idx, item in self._parse_data():
-                if self._should_create_chunk(items, item):
-                    self._create_chunk(start_idx, previous_idx, items)
-                    items = []
-                    start_idx = idx
-                items.append((idx, item))
-                previous_idx = idx
-            if items:
-                self._create_chunk(start_idx, idx, items)
-            else:
-                # document has an header and no data lines
-                # valid document. So create a dummy chunk
-                # to have progression and status
-                self._create_chunk(-1, -1, [])
+            model = self.env[config.model_id.model]
+            chunk_ids = []
+            vals_list = []
+            independents = []
+            # the first chunk importing each key, only the keys of the
+            # subfields used to reference a record are kept
+            providers = {}
+            reference_subfields = set()
+            if config.process_multi:
+                reference_subfields = chunk_model._get_reference_subfields(
+                    model, config._get_header()
+                )
+            for position, (start_idx, stop_idx, items) in enumerate(
+                self._iter_chunk_items(rows)
+            ):
+                vals = self._prepare_chunk(start_idx, stop_idx, items)
+                depends_on = set()
+                if config.process_multi:
+                    # the columns can differ between the rows (ex: json)
+                    reference_subfields |= chunk_model._get_reference_subfields(
+                        model, {header for __, item in items for header in item}
+                    )
+                    for key in chunk_model._get_references(model, items):
+                        if key in providers:
+                            depends_on.add(providers[key])
+                    for key in chunk_model._get_provided_keys(
+                        model, items, reference_subfields
+                    ):
+                        providers.setdefault(key, position)
+                if any(pos >= len(chunk_ids) for pos in depends_on):
+                    # the chunk depends on a chunk not created yet
+                    chunk_ids += self._create_chunks(vals_list).ids
+                    vals_list = []
+                if depends_on:
+                    vals["state"] = "waiting"
+                    vals["depends_on_ids"] = [
+                        (6, 0, [chunk_ids[pos] for pos in sorted(depends_on)])
+                    ]
+                else:
+                    independents.append(position)
+                vals_list.append(vals)
+                if len(vals_list) >= CHUNK_CREATE_BATCH:
+                    chunk_ids += self._create_chunks(vals_list).ids
+                    vals_list = []
+            if vals_list:
+                chunk_ids += self._create_chunks(vals_list).ids
+            # we enqueue all the independent chunks in case of multi process
+            # else we only enqueue the first chunk
+            if not config.process_multi:
+                independents = independents[:1]
+            for position in independents:
+                chunk_model.browse(chunk_ids[position]).with_delay(
+                    priority=config.job_priority
+                ).run()
         except Exception as e:
             self.state = "failed"
             self.info = _("Failed to create the chunk: %s") % e
         return True
 
+    def _prepare_export_chunk(self, start_idx, stop_idx, ids):
+        return {
+            "start_idx": start_idx,
+            "stop_idx": stop_idx,
+            "data": ids,
+            "nbr_item": len(ids),
+            "state": "pending",
+            "pattern_file_id": self.id,
+        }
+
+    def split_export_in_chunk(self, records):
+        """Split the records to export into Pattern Chunk exported in parallel"""
+        config = self.pattern_config_id
+        vals_list = []
+        start_idx = 1
+        for ids in split_every(config.chunk_size, records.ids, list):
+            stop_idx = start_idx + len(ids) - 1
+            vals_list.append(self._prepare_export_chunk(start_idx, stop_idx, ids))
+            start_idx = stop_idx + 1
+        chunks = self.env["pattern.chunk"].create(vals_list)
+        # all the chunks are created before being enqueued
+        # so the last chunk processed can not miss one of them
+        for chunk in chunks:
+            chunk.with_delay(priority=config.job_priority).run_export()
+        return True
+
+    def _get_export_parts(self):
+        """Iterate on the files exported by each chunk"""
+        for chunk in self.chunk_ids:
+            yield BytesIO(chunk._get_export_attachment().raw or b"")
+
+    def merge_export(self):
+        """Merge the files exported by each chunk into the pattern file"""
+        self.ensure_one()
+        if "failed" in self.chunk_ids.mapped("state"):
+            self.write(
+                {
+                    "state": "failed",
+                    "info": _("Failed to export some chunks"),
+                    "date_done": fields.Datetime.now(),
+                }
+            )
+            self._unlink_export_parts()
+            return "Pattern file has failed"
+        config = self.pattern_config_id
+        ids = [record_id for chunk in self.chunk_ids for record_id in chunk.data]
+        records = self.env[config.resource].browse(ids)
+        target_function = "_merge_export_parts_{}".format(config.export_format)
+        with tempfile.SpooledTemporaryFile(max_size=SPOOLED_MAX_SIZE) as output:
+            getattr(config, target_function)(records, self._get_export_parts(), output)
+            output.seek(0)
+            self.write(
+                {
+                    "raw": output.read(),
+                    "state": "done",
+                    "date_done": fields.Datetime.now(),
+                }
+            )
+        self._unlink_export_parts()
+        return "Pattern file has been exported"
+
+    def _unlink_export_parts(self):
+        self.env["ir.attachment"].search(
+            [("res_model", "=", "pattern.chunk"), ("res_id", "in", self.chunk_ids.ids)]
+        ).unlink()
+
+    def _get_row_errors(self):
+        """Return the error message of each row in error, the messages of
+        the chunks without error (ex: imported again) are only kept
+        as history
+        @return: dict {row number: message}
+        """
+        errors = {}
+        for chunk in self.chunk_ids:
+            if not chunk.nbr_error:
+                continue
+            last_row_idx = chunk.start_idx
+            for message in chunk.messages or []:
+                if "rows" in message:
+                    last_row_idx = message["rows"]["to"]
+                    errors[last_row_idx] = message["message"].strip()
+                else:
+                    # If no row are specify, this is a global message
+                    # that should be applied until the end of the chunk
+                    for idx in range(last_row_idx, chunk.stop_idx + 1):
+                        errors[idx] = message["message"].strip()
+        return errors
+
+    def _get_error_rows(self):
+        """Return the rows in error with their original values, read from
+        the data of the chunks (not available for the purged chunks)
+        @return: list of (row number, item, message)
+        """
+        errors = self._get_row_errors()
+        rows = []
+        for chunk in self.chunk_ids:
+            if not chunk.nbr_error or chunk.is_data_purged:
+                continue
+            for idx, item in chunk._get_data():
+                if idx in errors:
+                    rows.append((idx, item, errors[idx]))
+        return rows
+
+    def _get_error_report_function(self):
+        return "_write_error_report_{}".format(self.pattern_config_id.export_format)
+
+    def _can_generate_error_report(self):
+        return hasattr(self.pattern_config_id, self._get_error_report_function())
+
+    def generate_error_report(self):
+        """Write a file with only the rows in error, the error is added in
+        a commented column so the file can be fixed and imported again"""
+        for record in self:
+            config = record.pattern_config_id
+            if not record._can_generate_error_report():
+                raise UserError(
+                    _("The error report is not available for the format %s")
+                    % (config.export_format or "")
+                )
+            target_function = record._get_error_report_function()
+            header = [_("#Row"), _("#Error")]
+            items = []
+            for idx, item, message in record._get_error_rows():
+                # the commented columns of a previous error report are dropped
+                row = {k: v for k, v in item.items() if not k.startswith("#")}
+                for key in row:
+                    if key not in header:
+                        header.append(key)
+                row.update({header[0]: idx, header[1]: message})
+                items.append(row)
+            with tempfile.SpooledTemporaryFile(max_size=SPOOLED_MAX_SIZE) as output:
+                getattr(config, target_function)(header, items, output)
+                output.seek(0)
+                record.write(
+                    {
+                        "error_report": base64.b64encode(output.read()),
+                        "error_report_name": "{}.errors.{}".format(
+                            os.path.splitext(record.name)[0], config.export_format
+                        ),
+                    }
+                )
+        return True
+
+    def _get_failed_rows(self, failed_chunks):
+        """Return the rows to import again: the rows in error of the failed
+        chunks, or all their rows if the chunk has failed without row error
+        @return: list of (idx, item)
+        """
+        errors = self._get_row_errors()
+        rows = []
+        for chunk in failed_chunks:
+            data = chunk._get_data()
+            if chunk.messages:
+                rows += [(idx, item) for idx, item in data if idx in errors]
+            else:
+                rows += data
+        return rows
+
+    def retry_failed(self):
+        """Import again only the rows in error, the new chunks are built
+        with the data of the failed chunks (the file is not parsed again)"""
+        for record in self:
+            failed_chunks = record.chunk_ids.filtered(lambda c: c.state == "failed")
+            if not failed_chunks:
+                continue
+            if any(failed_chunks.mapped("is_data_purged")):
+                raise UserError(
+                    _(
+                        "The data of the failed chunks have been purged, "
+                        "please import the file again"
+                    )
+                )
+            rows = record._get_failed_rows(failed_chunks)
+            # the rows in error are moved in the new chunks,
+            # the messages are kept as history
+            for chunk in failed_chunks:
+                chunk.write(
+                    {"state": "done", "nbr_item": chunk.nbr_success, "nbr_error": 0}
+                )
+            record.write({"state": "pending", "info": False, "date_done": False})
+            if rows:
+                record._split_rows_in_chunk(rows)
+            else:
+                # the counters of the chunks have been changed
+                record.modified(["chunk_ids"])
+                record.set_import_done()
+        return True
+
     def set_import_done(self):
         for record in self:
             if record.nbr_error:
@@ -188,6 +601,20 @@ class PatternFile(models.Model):
             else:
                 record.state = "done"
             record.date_done = fields.Datetime.now()
+            if record.state == "failed" and record.pattern_config_id.error_report:
+                # called by the last chunk job, it must not fail
+                if not record._can_generate_error_report():
+                    _logger.warning(
+                        "No error report for the format %s of %s",
+                        record.pattern_config_id.export_format,
+                        record,
+                    )
+                    continue
+                try:
+                    with self.env.cr.savepoint():
+                        record.generate_error_report()
+                except Exception:
+                    _logger.exception("Fail to generate the error report of %s", record)
 
     def refresh(self):
         """Empty function to refresh view"""
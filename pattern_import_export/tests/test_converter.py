@@ -50,6 +50,21 @@ class TestConvertID(SavepointCase):
         self.converter.db_id_for(model, field, "name", "Rio de Janeiro")
         self.assertEqual(self.search_domain, [[("name", "=", "Rio de Janeiro")]])
 
+    def test_lookup_is_cached(self):
+        model = self.env["res.partner"]
+        field = model._fields["state_id"]
+        self._patch_search("res.country.state")
+        converter = self.converter.with_context(
+            pattern_config={"model": "res.partner", "lookup_cache": {}}
+        )
+        for _i in range(3):
+            converter.db_id_for(model, field, "name", "Rio de Janeiro")
+        converter.db_id_for(model, field, "name", "Alagoas")
+        self.assertEqual(
+            self.search_domain,
+            [[("name", "=", "Rio de Janeiro")], [("name", "=", "Alagoas")]],
+        )
+
     def test_convert_value_to_domain(self):
         field_name = None
         value = {
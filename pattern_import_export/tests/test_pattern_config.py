@@ -2,6 +2,7 @@
 # @author Sébastien BEAU <sebastien.beau@akretion.com>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
+from base64 import b64encode
 
 from odoo.tests import SavepointCase
 
@@ -27,3 +28,65 @@ class TestConfig(SavepointCase):
         self.assertEqual(lines[0].level, 0)
         self.assertEqual(lines[1].level, 1)
         self.assertEqual(lines[2].level, 0)
+
+    def test_header_cache_invalidation(self):
+        config = self.env["pattern.config"].create(
+            {
+                "name": "Partner",
+                "resource": "res.partner",
+                "export_fields": [
+                    (0, 0, {"name": "name"}),
+                    (0, 0, {"name": "category_id/name", "number_occurence": 1}),
+                ],
+            }
+        )
+        self.assertEqual(config._get_header(), ["name", "category_id|1|name"])
+        config.export_fields[1].number_occurence = 2
+        self.assertEqual(
+            config._get_header(),
+            ["name", "category_id|1|name", "category_id|2|name"],
+        )
+        config.export_fields[0].is_key = True
+        self.assertEqual(
+            config._get_header(),
+            ["name#key", "category_id|1|name", "category_id|2|name"],
+        )
+
+    def test_json_parser_cache_without_record(self):
+        resolver = self.env["ir.exports.resolver"].create(
+            {"name": "Upper", "python_code": "value = value.upper()"}
+        )
+        config = self.env["pattern.config"].create(
+            {
+                "name": "Partner",
+                "resource": "res.partner",
+                "export_fields": [
+                    (0, 0, {"name": "name", "resolver_id": resolver.id}),
+                    (0, 0, {"name": "country_id/code"}),
+                ],
+            }
+        )
+        cached = config._get_cached_json_parser()
+        self.assertEqual(cached[0], {"name": "name", "resolver": resolver.id})
+        parser = config._get_json_parser()
+        self.assertEqual(parser["fields"][0]["resolver"], resolver)
+        self.assertEqual(parser["fields"][0]["resolver"].env, self.env)
+        self.assertEqual(parser["fields"][1][1], [{"name": "code"}])
+
+    def test_pattern_file_counts(self):
+        config = self.env["pattern.config"].create(
+            {"name": "Partner", "resource": "res.partner"}
+        )
+        for state in ("pending", "done", "done", "failed"):
+            self.env["pattern.file"].create(
+                {
+                    "datas": b64encode(b"[]"),
+                    "name": "foo.json",
+                    "kind": "import",
+                    "state": state,
+                    "pattern_config_id": config.id,
+                }
+            )
+        self.assertEqual(config.count_pattern_file_pending, 1)
+        self.assertEqual(config.count_pattern_file_done, 2)
+        self.assertEqual(config.count_pattern_file_failed, 1)
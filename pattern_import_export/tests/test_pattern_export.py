@@ -386,6 +386,52 @@ class PatternTestExport(PatternCommon, SavepointCase, PatternCaseExport):
     def _get_data(self, pattern_config, records):
         return pattern_config._get_data_to_export(records)
 
+    def test_get_data_to_export_by_batch(self):
+        expected_results = list(self._get_data(self.pattern_config_o2m, self.partners))
+        self.pattern_config_o2m.export_batch_size = 2
+        results = list(self._get_data(self.pattern_config_o2m, self.partners))
+        self.assertEqual(len(results), 3)
+        self.assertEqual(expected_results, results)
+
+    def test_compile_header_path(self):
+        self.assertEqual(
+            self.pattern_config._compile_header_path("child_ids|2|country_id#key|code"),
+            ("child_ids", 1, "country_id", "code"),
+        )
+        self.assertEqual(
+            self.pattern_config._compile_header_path("child_ids|1|.id"),
+            ("child_ids", 0, "id"),
+        )
+
+    def test_export_jsonl(self):
+        self.pattern_config.export_format = "jsonl"
+        pattern_file = self.pattern_config._export_with_record(self.partners)
+        items = [item for __, item in pattern_file._parse_data()]
+        self.assertEqual(len(items), 3)
+        self.assertEqual(
+            items, list(self._get_data(self.pattern_config, self.partners))
+        )
+
+    def test_export_json(self):
+        self.pattern_config.export_format = "json"
+        pattern_file = self.pattern_config._export_with_record(self.partners)
+        items = [item for __, item in pattern_file._parse_data()]
+        self.assertEqual(
+            items, list(self._get_data(self.pattern_config, self.partners))
+        )
+
+    def test_export_json_by_chunk(self):
+        self.pattern_config.write(
+            {"export_format": "json", "export_multi": True, "chunk_size": 1}
+        )
+        pattern_file = self.pattern_config._export_with_record(self.partners)
+        self.assertEqual(pattern_file.state, "done")
+        self.assertEqual(len(pattern_file.chunk_ids), 3)
+        items = [item for __, item in pattern_file._parse_data()]
+        self.assertEqual(
+            items, list(self._get_data(self.pattern_config, self.partners))
+        )
+
     def test_get_metadata(self):
         result = self.pattern_config_o2m._get_metadata()
         self.assertEqual(len(result["tabs"]), 2)
@@ -1,7 +1,13 @@
 # Copyright 2020 Akretion France (http://www.akretion.com)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+import json
+from base64 import b64decode, b64encode
 from uuid import uuid4
 
+from mock import Mock
+
+from odoo import api
+from odoo.exceptions import UserError
 from odoo.tests.common import SavepointCase
 from odoo.tools import mute_logger
 
@@ -31,6 +37,22 @@ class TestPatternImport(PatternCommon, SavepointCase):
             "\n".join(pattern_file.mapped("chunk_ids.result_info")),
         )
 
+    def test_import_jsonl(self):
+        self.pattern_config.export_format = "jsonl"
+        names = [str(uuid4()), str(uuid4())]
+        data = "\n".join(json.dumps({"name": name}) for name in names) + "\n\n"
+        pattern_file = self.env["pattern.file"].create(
+            {
+                "datas": b64encode(data.encode("utf-8")),
+                "name": "foo.jsonl",
+                "kind": "import",
+                "pattern_config_id": self.pattern_config.id,
+            }
+        )
+        partners = self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(set(partners.mapped("name")), set(names))
+
     def test_update_inactive(self):
         unique_name = str(uuid4())
         partner = self.env["res.partner"].create({"name": unique_name, "active": False})
@@ -67,10 +89,8 @@ class TestPatternImport(PatternCommon, SavepointCase):
         # TODO it will be better to retour a better exception
         # but it's not that easy
         chunk = pattern_file.chunk_ids
-        self.assertEqual(
-            chunk.result_info,
-            "<p>Fail to process chunk 'int' object has no attribute 'split'</p>",
-        )
+        self.assertEqual(chunk.nbr_error, 1)
+        self.assertIn("'int' object has no attribute 'split'", chunk.result_info)
 
     def test_update_with_external_id_bad_data_2(self):
         """
@@ -312,6 +332,78 @@ class TestPatternImport(PatternCommon, SavepointCase):
         self.run_pattern_file(pattern_file)
         self.assertEqual(unique_name, self.partner_1.name)
 
+    def test_update_several_rows_with_key(self):
+        partner_2 = self.env.ref("base.res_partner_2")
+        self.partner_1.ref = "bulk_main_1"
+        partner_2.ref = "bulk_main_2"
+        contact_1 = self.env.ref("base.res_partner_address_1")
+        contact_1.ref = "bulk_child_1"
+        new_ref = str(uuid4())
+        data = [
+            {
+                "ref#key": self.partner_1.ref,
+                "name": "Bulk 1",
+                "child_ids|1|ref#key": contact_1.ref,
+                "child_ids|1|name": "Bulk Child 1",
+            },
+            {"ref#key": partner_2.ref, "name": "Bulk 2"},
+            {"ref#key": new_ref, "name": "Bulk 3"},
+        ]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        records = self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(self.partner_1.name, "Bulk 1")
+        self.assertEqual(contact_1.name, "Bulk Child 1")
+        self.assertEqual(partner_2.name, "Bulk 2")
+        self.assertEqual(records.ref, new_ref)
+
+    def test_import_duplicated_key_in_chunk(self):
+        self.partner_1.ref = "dup_key_1"
+        new_ref = str(uuid4())
+        data = [
+            {"ref#key": new_ref, "name": "First", "street": "Street 1"},
+            {"ref#key": self.partner_1.ref, "name": "Other"},
+            {"ref#key": new_ref, "name": "Second"},
+        ]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        records = self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        # the last row updates the partner created by the first row
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records.name, "Second")
+        self.assertEqual(records.street, "Street 1")
+
+    def test_convert_records_after_global_message(self):
+        # ex: the interruption message added by a flush during the conversion
+        messages = [{"type": "warning", "message": "Interrupted"}]
+        converted = list(
+            self.env["res.partner"]._convert_records(
+                [({"name": "Foo"}, {"rows": {"from": 2, "to": 2}})],
+                log=messages.append,
+            )
+        )
+        self.assertEqual(len(converted), 1)
+
+    def test_search_records_by_keys(self):
+        partner_2 = self.env.ref("base.res_partner_2")
+        partner_2.ref = "bulk_dup"
+        self.partner_1.ref = "bulk_dup"
+        country = self.env.ref("base.fr")
+        results = self.env["res.partner"]._search_records_by_keys(
+            [
+                [("id", str(self.partner_1.id))],
+                [("ref", "bulk_dup")],
+                [("ref", "bulk_dup"), ("name", self.partner_1.name)],
+                [("ref", str(uuid4()))],
+            ]
+        )
+        self.assertEqual(results[0], self.partner_1)
+        self.assertEqual(results[1], self.partner_1 | partner_2)
+        self.assertEqual(results[2], self.partner_1)
+        self.assertFalse(results[3])
+        results = self.env["res.country"]._search_records_by_keys([[("code", "FR")]])
+        self.assertEqual(results[0], country)
+
     def test_update_o2m_with_sub_keys(self):
         unique_name = str(uuid4())
 
@@ -504,6 +596,32 @@ class TestPatternImport(PatternCommon, SavepointCase):
         self.assertEqual(partner.name, name)
         self.assertEqual(partner.country_id.code, "FR")
 
+    def test_import_prefetch_related_records(self):
+        category = self.env["res.partner.category"].create({"name": str(uuid4())})
+        data = [
+            {"name": "a", "country_id|code": "FR", "category_id|1|name": category.name},
+            {"name": "b", "country_id|code": "BE", "child_ids|1|name": "b1"},
+            {"name": "c", "country_id|code": "FR", "child_ids|1|country_id|code": "BE"},
+        ]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        partners = self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        model = self.env["res.partner"]
+        chunk = pattern_file.chunk_ids
+        related_values = chunk._get_related_values(model, chunk._get_data())
+        self.assertEqual(
+            related_values,
+            {
+                (model._fields["country_id"], "code"): {"FR", "BE"},
+                (model._fields["category_id"], "name"): {category.name},
+            },
+        )
+        partner_a = partners.filtered(lambda p: p.name == "a")
+        self.assertEqual(partner_a.country_id.code, "FR")
+        self.assertEqual(partner_a.category_id, category)
+        partner_c = partners.filtered(lambda p: p.name == "c")
+        self.assertEqual(partner_c.child_ids.country_id.code, "BE")
+
     def test_import_m2o_db_id_key(self):
         name = str(uuid4())
         ref = str(uuid4())
@@ -531,6 +649,229 @@ class TestPatternImport(PatternCommon, SavepointCase):
         self.assertEqual(len(partners), 2)
         self.assertEqual(partners[0], partners[1].parent_id)
 
+    def test_import_m2o_parent_unqualified_external_id(self):
+        data = [
+            {"id": "pattern_parent", "name": "Apple"},
+            {"name": "Steve Jobs", "parent_id|id": "pattern_parent"},
+        ]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        partners = self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        parent = self.env.ref("__import__.pattern_parent")
+        self.assertEqual(partners, parent | parent.child_ids)
+        self.assertEqual(parent.child_ids.name, "Steve Jobs")
+
+    def test_import_m2o_parents_flush_only_if_needed(self):
+        batch_sizes = []
+
+        def _load_records(self, data_list, update=False):
+            batch_sizes.append(len(data_list))
+            return _load_records.origin(self, data_list, update=update)
+
+        parent_name = str(uuid4())
+        data = [
+            {"name": "Apple"},
+            {"name": "Steve Jobs", "parent_id|name": self.partner_1.name},
+            {"name": parent_name},
+            {"name": "Tim Cook", "parent_id|name": parent_name},
+            {"name": "Jony Ive"},
+        ]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        self.env["res.partner"]._patch_method("_load_records", _load_records)
+        try:
+            partners = self.run_pattern_file(pattern_file)
+        finally:
+            self.env["res.partner"]._revert_method("_load_records")
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(len(partners), 5)
+        # the first lookup do not need to flush the pending rows
+        self.assertEqual(batch_sizes, [3, 2])
+        tim_cook = partners.filtered(lambda p: p.name == "Tim Cook")
+        self.assertEqual(tim_cook.parent_id.name, parent_name)
+
+    def test_import_multi_chunk_with_dependency(self):
+        self.pattern_config.write({"chunk_size": 1, "process_multi": True})
+        data = [
+            {"name#key": "Apple"},
+            {"name": str(uuid4())},
+            {"name#key": "Steve Jobs", "parent_id|name": "Apple"},
+            {"name": str(uuid4())},
+            {"name": str(uuid4())},
+            {"name": str(uuid4()), "parent_id|name": self.partner_1.name},
+        ]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        partners = self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(len(partners), 6)
+        chunk_1, chunk_2, chunk_3 = pattern_file.chunk_ids.sorted("start_idx")
+        self.assertFalse(chunk_1.depends_on_ids)
+        self.assertEqual(chunk_2.depends_on_ids, chunk_1)
+        self.assertFalse(chunk_3.depends_on_ids)
+        steve = partners.filtered(lambda p: p.name == "Steve Jobs")
+        self.assertEqual(steve.parent_id.name, "Apple")
+
+    def test_import_compressed_chunk(self):
+        self.pattern_config.chunk_compression = True
+        names = [str(uuid4()), str(uuid4())]
+        data = [{"name": name} for name in names]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        partners = self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(set(partners.mapped("name")), set(names))
+        chunk = pattern_file.chunk_ids
+        self.assertFalse(chunk.data)
+        self.assertTrue(chunk.compressed_data)
+        self.assertEqual(chunk._get_data(), [[1, data[0]], [2, data[1]]])
+
+    def test_import_split_in_many_chunks(self):
+        self.pattern_config.write({"chunk_size": 1, "process_multi": True})
+        parent_name = str(uuid4())
+        data = [{"name#key": parent_name}]
+        data += [{"name": str(uuid4())} for _i in range(28)]
+        data.append({"name": str(uuid4()), "parent_id|name": parent_name})
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        partners = self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(len(partners), 30)
+        chunks = pattern_file.chunk_ids.sorted("start_idx")
+        self.assertEqual(len(chunks), 15)
+        self.assertEqual(chunks[-1].depends_on_ids, chunks[0])
+        self.assertFalse(chunks[:-1].depends_on_ids)
+        child = partners.filtered(lambda p: p.parent_id)
+        self.assertEqual(child.parent_id.name, parent_name)
+
+    def test_provided_keys_of_reference_subfields(self):
+        chunk_model = self.env["pattern.chunk"]
+        partner_model = self.env["res.partner"]
+        subfields = chunk_model._get_reference_subfields(
+            partner_model,
+            ["name", "ref#key", "parent_id|ref", "country_id|code", "#Error"],
+        )
+        self.assertEqual(subfields, {"ref"})
+        data = [
+            (1, {"name": "Foo", "ref#key": "foo", "email": "foo@example.org"}),
+            (2, {"name": "Bar", "ref#key": "bar", "parent_id|ref": "foo"}),
+        ]
+        self.assertEqual(
+            chunk_model._get_provided_keys(partner_model, data, subfields),
+            {("ref", "foo"), ("ref", "bar")},
+        )
+
+    def test_import_chunk_sizing_by_duration(self):
+        self.pattern_config.write({"chunk_size": 3, "chunk_sizing": "duration"})
+        data = [
+            {"name": str(uuid4())},
+            {"name": str(uuid4())},
+            {
+                "name": str(uuid4()),
+                "child_ids|1|name": str(uuid4()),
+                "child_ids|2|name": str(uuid4()),
+            },
+            {"name": str(uuid4())},
+        ]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        partners = self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(len(partners), 6)
+        chunks = pattern_file.chunk_ids.sorted("start_idx")
+        self.assertEqual(chunks.mapped("nbr_item"), [2, 1, 1])
+        self.assertAlmostEqual(chunks[1].estimated_cost, 3.03)
+
+        # the next chunks are sized with the timing of the previous ones
+        chunks.write({"duration": 0.5})
+        total_cost = sum(chunks.mapped("estimated_cost"))
+        self.assertAlmostEqual(
+            self.pattern_config._get_chunk_max_cost(),
+            self.pattern_config.chunk_duration / (1.5 / total_cost),
+        )
+
+    def test_import_chunk_sizing_by_duration_hook(self):
+        self.pattern_config.write({"chunk_size": 1, "chunk_sizing": "duration"})
+
+        def _should_create_chunk(self, items, next_item):
+            # keep the items without name with the previous item
+            if not next_item.get("name"):
+                return False
+            return _should_create_chunk.origin(self, items, next_item)
+
+        data = [
+            {"name": str(uuid4())},
+            {"name": None, "street": "Street"},
+            {"name": str(uuid4())},
+        ]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        self.env["pattern.file"]._patch_method(
+            "_should_create_chunk", _should_create_chunk
+        )
+        try:
+            chunks = [items for __, __, items in pattern_file._iter_chunk_items()]
+        finally:
+            self.env["pattern.file"]._revert_method("_should_create_chunk")
+        self.assertEqual([len(items) for items in chunks], [2, 1])
+
+    def test_check_last_on_processed_file(self):
+        data = [{"name": str(uuid4())}]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        date_done = pattern_file.date_done
+        chunk = pattern_file.chunk_ids
+        self.assertTrue(chunk.is_last_job())
+        self.assertEqual(pattern_file._get_chunk_states(), {"done": 1})
+        # a chunk checked again does not process the file twice
+        self.assertEqual(chunk.check_last(), "Pattern file is already processed")
+        self.assertEqual(pattern_file.date_done, date_done)
+
+    def test_check_last_failure_is_delayed(self):
+        data = [{"name": str(uuid4())}]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        calls = []
+
+        def set_import_done(self):
+            calls.append(self)
+            if len(calls) == 1:
+                raise ValueError("Check failure")
+            return set_import_done.origin(self)
+
+        rollback = self.env.cr.rollback
+        self.env.cr.rollback = Mock()
+        self.env["pattern.file"]._patch_method("set_import_done", set_import_done)
+        try:
+            partners = self.run_pattern_file(pattern_file)
+        finally:
+            self.env["pattern.file"]._revert_method("set_import_done")
+            self.env.cr.rollback = rollback
+        # the check is done again in a new job, the chunk is not imported again
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(partners), 1)
+        self.assertPatternDone(pattern_file)
+        chunk = pattern_file.chunk_ids
+        self.assertEqual(chunk.run(), "Chunk already processed")
+
+    def test_purge_chunk_data(self):
+        self.pattern_config.chunk_data_retention_days = 30
+        data = [{"name": str(uuid4())}]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        self.run_pattern_file(pattern_file)
+        chunk = pattern_file.chunk_ids
+
+        # the data of the recent chunks are kept
+        self.env["pattern.chunk"]._purge_data()
+        self.assertFalse(chunk.is_data_purged)
+        self.assertTrue(chunk.data)
+
+        self.env.cr.execute(
+            "UPDATE pattern_chunk SET write_date = now() - interval '31 days' "
+            "WHERE id = %s",
+            (chunk.id,),
+        )
+        chunk.invalidate_cache()
+        self.env["pattern.chunk"]._purge_data()
+        self.assertTrue(chunk.is_data_purged)
+        self.assertFalse(chunk.data)
+        self.assertEqual(chunk.nbr_success, 1)
+        self.assertEqual(pattern_file.nbr_success, 1)
+
     def test_update_m2m_with_a_lot_of_item(self):
         unique_name = str(uuid4())
         data = {"name": unique_name}
@@ -557,6 +898,173 @@ class TestPatternImport(PatternCommon, SavepointCase):
         self.assertEqual(pattern_file.nbr_error, 1)
         self.assertEqual(pattern_file.nbr_success, 3)
 
+    @mute_logger("odoo.sql_db")
+    def test_partial_import_isolate_failing_rows(self):
+        data = [{"name": str(idx)} for idx in range(8)]
+        data[5] = {"name": "", "street": "empty"}
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        records = self.run_pattern_file(pattern_file)
+        self.assertEqual(len(records), 7)
+        self.assertEqual(pattern_file.nbr_error, 1)
+        chunk = pattern_file.chunk_ids
+        self.assertEqual(len(chunk.messages), 1)
+        self.assertEqual(chunk.messages[0]["rows"], {"from": 6, "to": 6})
+        self.assertEqual(set(chunk.record_ids), set(records.ids))
+
+    def test_partial_import_error_report(self):
+        self.pattern_config.error_report = True
+        data = [{"name": str(idx)} for idx in range(4)]
+        data[2] = {"name": "", "street": "empty"}
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        self.run_pattern_file(pattern_file)
+        self.assertEqual(pattern_file.state, "failed")
+        self.assertEqual(pattern_file.error_report_name, "foo.errors.json")
+        report = json.loads(b64decode(pattern_file.error_report))
+        self.assertEqual(len(report), 1)
+        self.assertEqual(report[0]["#Row"], 3)
+        self.assertEqual(report[0]["street"], "empty")
+        self.assertTrue(report[0]["#Error"])
+
+    def test_partial_import_error_report_imported_again(self):
+        self.pattern_config.error_report = True
+        data = [
+            {"#Row": 8, "#Error": "Old error", "name": "", "street": "empty"},
+            {"#Row": 9, "#Error": "Old error", "name": str(uuid4())},
+        ]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        self.run_pattern_file(pattern_file)
+        self.assertEqual(pattern_file.state, "failed")
+        report = json.loads(b64decode(pattern_file.error_report))
+        self.assertEqual(len(report), 1)
+        self.assertEqual(report[0]["#Row"], 1)
+        self.assertNotEqual(report[0]["#Error"], "Old error")
+
+    def test_partial_import_error_report_failure(self):
+        self.pattern_config.error_report = True
+        data = [{"name": "", "street": "empty"}]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+
+        def generate_error_report(self):
+            raise ValueError("Report failure")
+
+        self.env["pattern.file"]._patch_method(
+            "generate_error_report", generate_error_report
+        )
+        try:
+            self.run_pattern_file(pattern_file)
+        finally:
+            self.env["pattern.file"]._revert_method("generate_error_report")
+        self.assertEqual(pattern_file.state, "failed")
+        self.assertTrue(pattern_file.date_done)
+        self.assertFalse(pattern_file.error_report)
+
+    def test_partial_import_error_report_not_available(self):
+        self.pattern_config.error_report = True
+        data = [{"name": "", "street": "empty"}]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+
+        def _get_error_report_function(self):
+            return "_write_error_report_missing_format"
+
+        self.env["pattern.file"]._patch_method(
+            "_get_error_report_function", _get_error_report_function
+        )
+        try:
+            self.run_pattern_file(pattern_file)
+            self.assertEqual(pattern_file.state, "failed")
+            self.assertFalse(pattern_file.error_report)
+            with self.assertRaises(UserError):
+                pattern_file.generate_error_report()
+        finally:
+            self.env["pattern.file"]._revert_method("_get_error_report_function")
+
+    def test_retry_failed_rows(self):
+        name = str(uuid4())
+        data = [
+            {"name": str(uuid4())},
+            {"name": name, "country_id|code": "ZZ"},
+            {"name": str(uuid4())},
+        ]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        self.run_pattern_file(pattern_file)
+        self.assertEqual(pattern_file.state, "failed")
+        self.assertEqual(pattern_file.nbr_error, 1)
+
+        # the missing reference is added, only the row in error is imported
+        country = self.env["res.country"].create({"name": "Zed", "code": "ZZ"})
+        pattern_file.retry_failed()
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(pattern_file.nbr_success, 3)
+        self.assertEqual(pattern_file.nbr_error, 0)
+        first_chunk, retry_chunk = pattern_file.chunk_ids.sorted("id")
+        self.assertEqual(retry_chunk._get_data(), [[2, data[1]]])
+        self.assertEqual((retry_chunk.start_idx, retry_chunk.stop_idx), (2, 2))
+        # the error of the first import is kept
+        self.assertEqual(first_chunk.messages[0]["rows"], {"from": 2, "to": 2})
+        self.assertFalse(pattern_file._get_row_errors())
+        partner = self.env["res.partner"].search([("name", "=", name)])
+        self.assertEqual(partner.country_id, country)
+
+    def test_retry_failed_chunk(self):
+        names = [str(uuid4()), str(uuid4())]
+        data = [{"name": name} for name in names]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+
+        def _prefetch_related_records(self, model, data):
+            raise ValueError("Chunk failure")
+
+        self.env["pattern.chunk"]._patch_method(
+            "_prefetch_related_records", _prefetch_related_records
+        )
+        try:
+            self.assertFalse(self.run_pattern_file(pattern_file))
+        finally:
+            self.env["pattern.chunk"]._revert_method("_prefetch_related_records")
+        chunk = pattern_file.chunk_ids
+        self.assertEqual(chunk.state, "failed")
+        self.assertFalse(chunk.messages)
+
+        # all the rows of the chunk are imported again
+        pattern_file.retry_failed()
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(pattern_file.nbr_success, 2)
+        partners = self.env["res.partner"].search([("name", "in", names)])
+        self.assertEqual(len(partners), 2)
+
+    def test_partial_import_isolate_failing_row_exception(self):
+        partner_2 = self.env.ref("base.res_partner_2")
+        partner_2.ref = "bulk_dup"
+        self.partner_1.ref = "bulk_dup"
+        data = [{"name": str(idx)} for idx in range(5)]
+        data[2] = {"ref#key": "bulk_dup", "name": "ambiguous"}
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        records = self.run_pattern_file(pattern_file)
+        self.assertEqual(len(records), 4)
+        self.assertEqual(pattern_file.state, "failed")
+        self.assertEqual(pattern_file.nbr_error, 1)
+        chunk = pattern_file.chunk_ids
+        self.assertEqual(len(chunk.messages), 1)
+        self.assertEqual(chunk.messages[0]["rows"], {"from": 3, "to": 3})
+        self.assertIn("Too many", chunk.messages[0]["message"])
+
+    @mute_logger("odoo.sql_db")
+    def test_partial_import_vals_not_modified(self):
+        @api.model_create_multi
+        def create(self, vals_list):
+            for vals in vals_list:
+                vals["comment"] = (vals.get("comment") or "") + "x"
+            return create.origin(self, vals_list)
+
+        data = [{"name": "foo"}, {"name": "", "street": "empty"}, {"name": "bar"}]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        self.env["res.partner"]._patch_method("create", create)
+        try:
+            records = self.run_pattern_file(pattern_file)
+        finally:
+            self.env["res.partner"]._revert_method("create")
+        self.assertEqual(pattern_file.nbr_error, 1)
+        self.assertEqual(records.mapped("comment"), ["x", "x"])
+
     @mute_logger("odoo.sql_db")
     def test_partial_import_too_many_error(self):
         data = (
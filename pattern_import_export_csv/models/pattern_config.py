@@ -1,8 +1,10 @@
 # Copyright 2020 Akretion France (http://www.akretion.com)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 # pylint: disable=missing-manifest-dependency
+import codecs
 import csv
 import io
+import shutil
 
 from odoo import fields, models
 
@@ -20,19 +22,64 @@ class PatternConfig(models.Model):
         for row in self._get_data_to_export(records):
             writer.writerow(row)
 
-    def _export_with_record_csv(self, records):
+    def _export_to_file_csv(self, records, output):
+        """
+        Write the csv export in the binary file given
+        @param records: recordset
+        @param output: binary file object
+        """
         self.ensure_one()
-        output = io.StringIO()
+        # the writer encode each row on the fly so the whole csv is never
+        # kept as a string in memory
+        text_output = codecs.getwriter("utf_8")(output)
         headers = self._get_output_headers()
         fieldnames = headers[0].keys()
         writer = csv.DictWriter(
-            output,
+            text_output,
             delimiter=self.csv_value_delimiter,
             quotechar=self.csv_quote_character,
             fieldnames=fieldnames,
         )
-        for line in headers:
-            writer.writerow(line)
+        if not self._context.get("pattern_export_part"):
+            for line in headers:
+                writer.writerow(line)
         self._csv_write_rows(writer, records)
-        output.seek(0)
-        return output.getvalue().encode("utf_8")
+
+    def _merge_export_parts_csv(self, records, parts, output):
+        """
+        Write the header and concatenate the files exported by each chunk
+        @param records: recordset exported
+        @param parts: iterator of binary file object
+        @param output: binary file object
+        """
+        self.ensure_one()
+        self._export_to_file_csv(self.env[self.resource].browse(), output)
+        for part in parts:
+            shutil.copyfileobj(part, output)
+
+    def _write_error_report_csv(self, header, items, output):
+        """
+        Write the rows in error in the binary file given
+        @param header: list of the columns
+        @param items: list of dict
+        @param output: binary file object
+        """
+        self.ensure_one()
+        text_output = codecs.getwriter("utf_8")(output)
+        writer = csv.DictWriter(
+            text_output,
+            delimiter=self.csv_value_delimiter,
+            quotechar=self.csv_quote_character,
+            fieldnames=header,
+        )
+        # the header is repeated to keep the number of header rows
+        for _idx in range(self.nr_of_header_rows):
+            writer.writeheader()
+        for item in items:
+            writer.writerow(item)
+
+    def _export_with_record_csv(self, records):
+        self.ensure_one()
+        output = io.BytesIO()
+        self._export_to_file_csv(records, output)
+        return output.getvalue()
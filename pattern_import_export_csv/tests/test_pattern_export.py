@@ -167,3 +167,45 @@ class TestPatternExportCsv(ExportPatternCsvCommon):
             ],
         ]
         self.assertEqual(csv_file_lines[1:3], expected_values)
+
+    def test_export_by_chunk(self):
+        expected_lines = self._helper_get_resulting_csv(
+            self.pattern_config_o2m, self.partners
+        )
+        self.pattern_config_o2m.write({"export_multi": True, "chunk_size": 1})
+        csv_file_lines = self._helper_get_resulting_csv(
+            self.pattern_config_o2m, self.partners
+        )
+        self.assertEqual(csv_file_lines, expected_lines)
+        pattern_file = self.env["pattern.file"].search(
+            [("pattern_config_id", "=", self.pattern_config_o2m.id)], limit=1
+        )
+        self.assertEqual(pattern_file.state, "done")
+        self.assertEqual(len(pattern_file.chunk_ids), 3)
+
+    def test_export_by_chunk_failed(self):
+        self.pattern_config_o2m.write({"export_multi": True, "chunk_size": 1})
+
+        def export_records(self):
+            export_records.origin(self)
+            if self.start_idx == 3:
+                raise ValueError("Export failure")
+
+        self.env["pattern.chunk"]._patch_method("export_records", export_records)
+        try:
+            self.pattern_config_o2m._export_with_record(self.partners)
+        finally:
+            self.env["pattern.chunk"]._revert_method("export_records")
+        pattern_file = self.env["pattern.file"].search(
+            [("pattern_config_id", "=", self.pattern_config_o2m.id)], limit=1
+        )
+        self.assertEqual(pattern_file.state, "failed")
+        # the parts exported by the other chunks are removed
+        self.assertFalse(
+            self.env["ir.attachment"].search(
+                [
+                    ("res_model", "=", "pattern.chunk"),
+                    ("res_id", "in", pattern_file.chunk_ids.ids),
+                ]
+            )
+        )
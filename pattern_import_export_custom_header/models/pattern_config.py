@@ -3,6 +3,7 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
 from odoo import fields, models
+from odoo.tools import ormcache
 
 
 class PatternConfig(models.Model):
@@ -17,14 +18,28 @@ class PatternConfig(models.Model):
         string="Custom Header names",
     )
 
+    def _get_pattern_cache_key(self):
+        key = super()._get_pattern_cache_key()
+        return key + tuple(
+            (item.id, item.sequence, item.name, item.initial_header_name)
+            for item in self.custom_header_ids
+        )
+
+    @ormcache("self._get_pattern_cache_key()")
+    def _get_custom_header_mapping(self):
+        """Return a list of (custom header name, initial header name)"""
+        return tuple(
+            (item.name, item.initial_header_name) for item in self.custom_header_ids
+        )
+
     def _map_with_custom_header(self, data):
         return {
-            item.name: data.get(item.initial_header_name)
-            for item in self.custom_header_ids
+            name: data.get(initial_header_name)
+            for name, initial_header_name in self._get_custom_header_mapping()
         }
 
-    def _get_data_to_export_by_record(self, record, parser):
-        data = super()._get_data_to_export_by_record(record, parser)
+    def _format_data_to_export(self, data, accessors=None):
+        data = super()._format_data_to_export(data, accessors=accessors)
         if self.header_format == "custom":
             return self._map_with_custom_header(data)
         else:
@@ -32,7 +47,7 @@ class PatternConfig(models.Model):
 
     def _get_output_headers(self):
         if self.header_format == "custom":
-            return [{item.name: item.name for item in self.custom_header_ids}]
+            return [{name: name for name, __ in self._get_custom_header_mapping()}]
         else:
             return super()._get_output_headers()
 
@@ -96,7 +96,14 @@ class PatternExportTask(models.Model):
         records = self._get_records_to_export()
         pattern_file = records.generate_export_with_pattern_job(self.pattern_config_id)
         pattern_file.export_task_id = self
-        self.env["attachment.queue"].create(
+        # in case of export by chunk the file is filled later
+        # and the attachment queue is created when merging the chunks
+        if pattern_file.state == "done":
+            self._create_attachment_queue(pattern_file)
+
+    def _create_attachment_queue(self, pattern_file):
+        self.ensure_one()
+        return self.env["attachment.queue"].create(
             {
                 "attachment_id": pattern_file.attachment_id.id,
                 "task_id": self.sync_task_id.id,
@@ -21,3 +21,9 @@ class PatternFile(models.Model):
             record.attachment_queue_ids = self.env["attachment.queue"].search(
                 [("attachment_id", "=", record.attachment_id.id)]
             )
+
+    def merge_export(self):
+        res = super().merge_export()
+        if self.state == "done" and self.export_task_id:
+            self.export_task_id._create_attachment_queue(self)
+        return res
@@ -19,30 +19,86 @@ class PatternConfig(models.Model):
     tab_to_import = fields.Selection(
         [("first", "First"), ("match_name", "Match Name")], default="first"
     )
+    xlsx_error_mode = fields.Selection(
+        [("column", "Error column"), ("sheet", "Error tab")],
+        default="column",
+        string="Errors of the import",
+        help="Write the errors of the import in a first column of the imported "
+        "tab, or only list them (row number and error) in a dedicated tab",
+    )
 
     # TODO we should move this code in pattern.file
-    def _create_xlsx_file(self, records):
+    def _create_xlsx_file(self, records, output=None):
+        """
+        Build the excel file with a write-only workbook, rows are appended
+        as soon as they are exported so the memory used stay constant
+        @param records: recordset
+        @param output: binary file object (a BytesIO is created if empty)
+        @return: binary file object
+        """
         self.ensure_one()
-        book = openpyxl.Workbook()
-        main_sheet = self._build_main_sheet_structure(book)
-        self._populate_main_sheet_rows(main_sheet, records)
+        if output is None:
+            output = BytesIO()
+        book = openpyxl.Workbook(write_only=True)
+        if self._context.get("pattern_export_part"):
+            # only the rows are exported, the header, tabs and validators
+            # are added when merging the parts
+            main_sheet = book.create_sheet(self.name)
+            self._populate_main_sheet_rows(main_sheet, records)
+        else:
+            main_sheet = self._build_main_sheet_structure(book)
+            self._populate_main_sheet_rows(main_sheet, records)
+            self._create_tabs_and_validators(book, main_sheet, records)
+        book.save(output)
+        return output
+
+    def _create_tabs_and_validators(self, book, main_sheet, records):
         tabs = self._get_metadata()["tabs"]
         self._create_tabs(book, tabs)
         self._create_validators(main_sheet, records, tabs)
-        book.close()
-        xlsx_file = BytesIO()
-        book.save(xlsx_file)
-        return xlsx_file
+
+    def _merge_export_parts_xlsx(self, records, parts, output):
+        """
+        Copy the rows of the files exported by each chunk in a new workbook
+        @param records: recordset exported
+        @param parts: iterator of binary file object
+        @param output: binary file object
+        """
+        self.ensure_one()
+        book = openpyxl.Workbook(write_only=True)
+        main_sheet = self._build_main_sheet_structure(book)
+        for part in parts:
+            part_book = openpyxl.load_workbook(part, read_only=True)
+            for row in part_book.worksheets[0].iter_rows(values_only=True):
+                main_sheet.append(row)
+            part_book.close()
+        self._create_tabs_and_validators(book, main_sheet, records)
+        book.save(output)
+
+    def _write_error_report_xlsx(self, header, items, output):
+        """
+        Write the rows in error in the binary file given
+        @param header: list of the columns
+        @param items: list of dict
+        @param output: binary file object
+        """
+        self.ensure_one()
+        book = openpyxl.Workbook(write_only=True)
+        sheet = book.create_sheet(self.name)
+        # the header is repeated to keep the number of header rows
+        for _idx in range(self.nr_of_header_rows):
+            sheet.append(header)
+        for item in items:
+            sheet.append([item.get(key) for key in header])
+        book.save(output)
 
     def _build_main_sheet_structure(self, book):
         """
         Write main sheet header and other style details
         """
-        main_sheet = book["Sheet"]
-        main_sheet.title = self.name
-        for row, lines in enumerate(self._get_output_headers(), start=1):
-            for col, header in enumerate(lines.values(), start=1):
-                main_sheet.cell(row=row, column=col, value=header)
+        main_sheet = book.create_sheet(self.name)
+        for lines in self._get_output_headers():
+            main_sheet.append(list(lines.values()))
         return main_sheet
 
     def _populate_main_sheet_rows(self, main_sheet, records):
@@ -50,22 +106,17 @@ class PatternConfig(models.Model):
         Get the actual data and write it row by row on the main sheet
         """
         headers = self._get_header()
-        for row, values in enumerate(
-            self._get_data_to_export(records), start=self.row_start_records
-        ):
-            for col, header in enumerate(headers, start=1):
-                main_sheet.cell(row=row, column=col, value=values.get(header, ""))
+        for values in self._get_data_to_export(records):
+            main_sheet.append([values.get(header, "") for header in headers])
 
     def _create_tabs(self, book, tabs):
         """Create additional sheets for export lines with create tab option
         and write all valid choices"""
         for tab_name, tab in tabs.items():
             new_sheet = book.create_sheet(tab_name)
-            for col_number, header in enumerate(tab["headers"], start=1):
-                new_sheet.cell(row=1, column=col_number, value=header)
-            for row_number, row_data in enumerate(tab["data"], start=2):
-                for col_number, cell_data in enumerate(row_data, start=1):
-                    new_sheet.cell(row=row_number, column=col_number, value=cell_data)
+            new_sheet.append(tab["headers"])
+            for row_data in tab["data"]:
+                new_sheet.append(row_data)
 
     def _create_validators(self, main_sheet, records, tabs):
         """Add validators: source permitted records from tab sheets,
@@ -91,7 +142,17 @@ class PatternConfig(models.Model):
                     str(max(main_sheet_length, 2)),
                 )
                 validation.add(range_dst)
-            main_sheet.add_data_validation(validation)
+            # write-only sheet do not have the add_data_validation method
+            main_sheet.data_validations.append(validation)
+
+    def _export_to_file_xlsx(self, records, output):
+        """
+        Write the excel export in the binary file given
+        @param records: recordset
+        @param output: binary file object
+        """
+        self.ensure_one()
+        self._create_xlsx_file(records, output=output)
 
     def _export_with_record_xlsx(self, records):
         """
@@ -2,7 +2,7 @@
 # @author Sébastien BEAU <sebastien.beau@akretion.com>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
-import base64
+import tempfile
 from io import BytesIO
 
 import openpyxl
@@ -10,7 +10,10 @@ import openpyxl
 from odoo import _, models
 from odoo.exceptions import UserError
 
+from odoo.addons.pattern_import_export.models.common import SPOOLED_MAX_SIZE
+
 STOP_AFTER_NBR_EMPTY = 10
+ERROR_SHEET_NAME = "#Errors"
 
 
 class PatternFile(models.Model):
@@ -39,21 +42,34 @@ class PatternFile(models.Model):
             raise UserError(_("Please select a tab to import on the pattern"))
         return workbook[name]
 
-    def _parse_data_xlsx(self, data):
-        workbook = openpyxl.load_workbook(BytesIO(data), data_only=True, read_only=True)
+    def _get_xlsx_columns(self, headers):
+        """Return the (index, header) of the columns to import,
+        the columns without header and the commented columns are skipped"""
+        return [
+            (index, header)
+            for index, header in enumerate(headers)
+            if header is not None
+            and not (isinstance(header, str) and header.startswith("#"))
+        ]
+
+    def _parse_data_xlsx(self, datafile):
+        workbook = openpyxl.load_workbook(datafile, data_only=True, read_only=True)
         worksheet = self._get_worksheet(workbook)
-        headers = None
+        columns = None
         count_empty = 0
-        for idx, row in enumerate(worksheet.rows):
+        # only the values are read (no cell object) and the item is only
+        # built with the columns to import
+        for idx, vals in enumerate(worksheet.iter_rows(values_only=True)):
             if self.pattern_config_id.nr_of_header_rows == idx + 1:
-                headers = [x.value for x in row]
-            elif headers:
-                vals = [x.value for x in row]
+                columns = self._get_xlsx_columns(vals)
+            elif columns is not None:
                 if any(vals):
                     count_empty = 0
-                    item = dict(zip(headers, vals))
-                    # we remove column without header
-                    item.pop(None, "")
+                    size = len(vals)
+                    item = {
+                        header: vals[index] if index < size else None
+                        for index, header in columns
+                    }
                     # the position return is the row number
                     # libreoffice/excel/human start from 1
                     yield idx + 1, item
@@ -63,33 +79,47 @@ class PatternFile(models.Model):
                 break
         workbook.close()
 
-    def write_error_in_xlsx(self):
-        # TODO writing in an existing big excel file is long with openpyxl
-        # maybe we should try some other tools
-        # https://editpyxl.readthedocs.io
-        infile = BytesIO(base64.b64decode(self.datas))
-        wb = openpyxl.load_workbook(filename=infile)
-        ws = self._get_worksheet(wb)
+    def _copy_sheet_with_errors(self, sheet, new_sheet, errors):
+        """Copy the rows of the sheet with the error in a first column,
+        the error column of a previous import is replaced"""
+        for idx, row in enumerate(sheet.iter_rows(values_only=True), start=1):
+            if idx == 1:
+                skip = 1 if row and row[0] == _("#Error") else 0
+                new_sheet.append((_("#Error"),) + row[skip:])
+            else:
+                new_sheet.append((errors.get(idx),) + row[skip:])
 
-        # we clear the error col if exist
-        if ws["A1"].value == _("#Error"):
-            ws.delete_cols(1)
-        ws.insert_cols(1)
-        ws.cell(1, 1, value=_("#Error"))
-        last_row_idx = 0
-        for chunk in self.chunk_ids:
-            for message in chunk.messages:
-                if "rows" in message:
-                    last_row_idx = message["rows"]["to"]
-                    ws.cell(message["rows"]["to"], 1, value=message["message"].strip())
-                else:
-                    # If no row are specify, this is a global message
-                    # that should be applied until the end of the chunk
-                    for idx in range(last_row_idx, chunk.stop_idx + 1):
-                        ws.cell(idx, 1, value=message["message"].strip())
-        output = BytesIO()
-        wb.save(output)
-        self.datas = base64.b64encode(output.getvalue())
+    def write_error_in_xlsx(self):
+        """Write the errors in a copy of the imported file.
+        The file is read and written in streaming mode (read only / write only
+        workbook) so the memory used stays constant, only the values are copied.
+        Depending on the pattern, the errors are written in a first column
+        of the imported tab or in a dedicated tab"""
+        errors = self._get_row_errors()
+        error_mode = self.pattern_config_id.xlsx_error_mode
+        source = openpyxl.load_workbook(BytesIO(self.raw), read_only=True)
+        imported_sheet = self._get_worksheet(source)
+        book = openpyxl.Workbook(write_only=True)
+        for sheet in source.worksheets:
+            if error_mode == "sheet" and sheet.title == ERROR_SHEET_NAME:
+                # errors of a previous import
+                continue
+            new_sheet = book.create_sheet(sheet.title)
+            if error_mode == "column" and sheet.title == imported_sheet.title:
+                self._copy_sheet_with_errors(sheet, new_sheet, errors)
+            else:
+                for row in sheet.iter_rows(values_only=True):
+                    new_sheet.append(row)
+        if error_mode == "sheet":
+            error_sheet = book.create_sheet(ERROR_SHEET_NAME)
+            error_sheet.append([_("Row"), _("Error")])
+            for idx in sorted(errors):
+                error_sheet.append([idx, errors[idx]])
+        source.close()
+        with tempfile.SpooledTemporaryFile(max_size=SPOOLED_MAX_SIZE) as output:
+            book.save(output)
+            output.seek(0)
+            self.raw = output.read()
 
     def set_import_done(self):
         super().set_import_done()
@@ -97,6 +127,7 @@ class PatternFile(models.Model):
             if (
                 record.state == "failed"
                 and record.pattern_config_id.export_format == "xlsx"
+                and not record.pattern_config_id.error_report
             ):
                 record.write_error_in_xlsx()
         return True
@@ -153,6 +153,29 @@ class TestPatternImportExcel(SavepointCase):
         self.assertIsNone(ws["A4"].value)
         self.assertEqual("'Contacts require a name'", ws["A5"].value)
 
+    @mute_logger("odoo.sql_db")
+    def test_partial_import_error_tab(self):
+        self.pattern_config_partner.xlsx_error_mode = "sheet"
+        pattern_file = self._load_file(
+            "example.partners.failed.xlsx", self.pattern_config_partner
+        )
+        self.assertEqual(pattern_file.state, "failed")
+
+        infile = BytesIO(base64.b64decode(pattern_file.datas))
+        wb = openpyxl.load_workbook(filename=infile)
+        # the imported tab is kept as is
+        self.assertNotEqual(wb.worksheets[0]["A1"].value, "#Error")
+        ws = wb["#Errors"]
+        self.assertEqual(ws["A1"].value, "Row")
+        self.assertEqual(ws["A2"].value, 5)
+        self.assertEqual(ws["B2"].value, "'Contacts require a name'")
+
+        # the errors of a new import replace the previous ones
+        pattern_file.write_error_in_xlsx()
+        infile = BytesIO(base64.b64decode(pattern_file.datas))
+        wb = openpyxl.load_workbook(filename=infile)
+        self.assertEqual(wb.sheetnames.count("#Errors"), 1)
+
     @mute_logger("odoo.sql_db")
     def test_partial_import_too_many_error(self):
         pattern_file = self._load_file(
@@ -268,3 +291,29 @@ class TestPatternImportExcel(SavepointCase):
         self.assertTrue(partner_parent)
         partner_child = self.env["res.partner"].search([("name", "=", "Steve Jobs")])
         self.assertTrue(partner_child.parent_id == partner_parent)
+
+    def test_parse_xlsx_only_imported_columns(self):
+        wb = openpyxl.Workbook()
+        ws = wb.active
+        ws.append(["#Error", "name", None, "#comment", "email"])
+        ws.append(["Some error", "Foo", "no header", "comment", "foo@example.com"])
+        ws.append([None, None, None, "only a comment", None])
+        ws.append([None, "Bar"])
+        output = BytesIO()
+        wb.save(output)
+        pattern_file = self.env["pattern.file"].create(
+            {
+                "datas": base64.b64encode(output.getvalue()),
+                "name": "example.xlsx",
+                "kind": "import",
+                "pattern_config_id": self.pattern_config_partner.id,
+            }
+        )
+        self.assertEqual(
+            list(pattern_file._parse_data()),
+            [
+                (2, {"name": "Foo", "email": "foo@example.com"}),
+                (3, {"name": None, "email": None}),
+                (4, {"name": "Bar", "email": None}),
+            ],
+        )